@@ -2,6 +2,16 @@ import cv2
 import numpy as np
 import time
 import os
+import sys
+import argparse
+import json
+import queue
+import signal
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.managers import SyncManager
+from collections import deque
 from datetime import datetime
 
 # -----------------------------
@@ -14,98 +24,316 @@ RECORD_VIDEO = True
 SAVE_LOG = True
 
 OUTPUT_DIR = "records"
-if not os.path.exists(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
 
-# -----------------------------
-# Load Haar Cascades
-# -----------------------------
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
-eye_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_eye.xml")
+# Streaming gaze aggregation (constant memory): eye-position heatmap on a
+# HEATMAP_CELL-pixel grid, dispersion-based fixations and blink detection.
+SHOW_HEATMAP = True
+SAVE_SUMMARY = True
+HEATMAP_CELL = 10
+HEATMAP_ALPHA = 0.4
+HEATMAP_REFRESH = 10            # frames between overlay re-renders
+FIXATION_DISPERSION = 25        # px, (max-min x) + (max-min y)
+FIXATION_MIN_DURATION = 0.1     # s
+BLINK_MIN_DURATION = 0.05       # s, face visible but no eyes
+BLINK_MAX_DURATION = 0.5        # s, longer gaps are lost eyes, not blinks
 
-# -----------------------------
-# Open Camera
-# -----------------------------
-cap = cv2.VideoCapture(CAMERA_INDEX)
-cap.set(3, FRAME_WIDTH)
-cap.set(4, FRAME_HEIGHT)
+# Binary gaze log: fixed-width records appended into preallocated chunks and
+# flushed by a background thread when a chunk fills or every GAZE_FLUSH_INTERVAL s.
+GAZE_LOG_CHUNK = 4096
+GAZE_FLUSH_INTERVAL = 1.0
+MAX_LOGGED_EYES = 4
 
-# -----------------------------
-# Video Writer
-# -----------------------------
-timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-video_path = os.path.join(OUTPUT_DIR, f"eye_record_{timestamp}.avi")
-log_path = os.path.join(OUTPUT_DIR, f"eye_log_{timestamp}.txt")
+# Pipeline queues: when a queue is full the OLDEST item is dropped, so a slow
+# stage never makes the camera or the UI fall behind real time.
+FRAME_QUEUE_SIZE = 2
+RESULT_QUEUE_SIZE = 2
+WRITER_QUEUE_SIZE = 32
 
-fourcc = cv2.VideoWriter_fourcc(*"XVID")
-out = cv2.VideoWriter(video_path, fourcc, 20.0, (FRAME_WIDTH, FRAME_HEIGHT))
+# Detection resolution: faces are detected on the gray frame downscaled by
+# DETECT_SCALE, eyes on the full-resolution face crop; boxes are scaled back.
+# The cascade window is 24 px, so at 0.5 faces under ~48 px are no longer found.
+DETECT_SCALE = 0.5
+# Cascade size limits in full-frame pixels so impossible scales are skipped.
+# (0, 0) disables a limit (cascade's native minimum). Raising FACE_MIN_SIZE
+# is much faster but drops smaller/distant faces. Eyes are capped at half the face.
+FACE_MIN_SIZE = (0, 0)
+FACE_MAX_SIZE = (0, 0)
+EYE_MIN_SIZE = (15, 15)
+
+# Multi-source mode: one worker process per camera/video, each with its own
+# recording and gaze log; the coordinator prints aggregate stats periodically.
+STATS_INTERVAL = 2.0
+STALL_TIMEOUT = 5.0
+WORKER_CV_THREADS = 1  # OpenCV threads per worker; processes provide the parallelism
+
+# Track-then-detect: full-frame face detection only every REDETECT_INTERVAL
+# frames or when a track is lost; in between only an ROI around the last
+# face box (expanded by ROI_MARGIN of its size on each side) is searched.
+TRACKING_MODE = True
+REDETECT_INTERVAL = 15
+ROI_MARGIN = 0.5
+# Optional OpenCV tracker used to propagate face boxes between scans
+# ("MIL", "KCF", "CSRT", "MOSSE" where available). None = ROI search only.
+TRACKER_TYPE = None
 
-# -----------------------------
-# Log file
-# -----------------------------
-if SAVE_LOG:
-    log_file = open(log_path, "w")
-    log_file.write("Time,X,Y,Width,Height\n")
 
 # -----------------------------
-# FPS Calculation
+# Pipeline helpers
 # -----------------------------
-prev_time = 0
+class DropOldestQueue:
+    """
+    Bounded queue that discards its oldest item instead of blocking the producer.
+    """
+
+    def __init__(self, maxsize):
+        self._queue = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, item):
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        return self._queue.get(timeout=timeout)
+
+
+class StageTimer:
+    """
+    Rolling per-stage latency samples (seconds), reported in milliseconds.
+    """
+
+    def __init__(self, window=300):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+
+    def mean_ms(self, stage):
+        with self._lock:
+            samples = list(self._samples.get(stage, ()))
+        return 1000.0 * sum(samples) / len(samples) if samples else 0.0
+
+    def summary(self):
+        with self._lock:
+            samples = {stage: np.array(values) * 1000.0 for stage, values in self._samples.items()}
+        return {
+            stage: {"mean_ms": float(v.mean()), "p95_ms": float(np.percentile(v, 95)), "samples": len(v)}
+            for stage, v in samples.items() if len(v)
+        }
+
 
-print("Eye Tracking Started")
-print("Press Q to Quit | R to Start/Stop Recording")
+class FPSMeter:
+    """
+    Frames per second over a sliding time window (not a single-frame delta).
+    """
+
+    def __init__(self, window=1.0):
+        self.window = window
+        self._ticks = deque()
+
+    def tick(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._ticks.append(now)
+        while now - self._ticks[0] > self.window:
+            self._ticks.popleft()
+        return self.fps()
+
+    def fps(self):
+        if len(self._ticks) < 2:
+            return 0.0
+        return (len(self._ticks) - 1) / (self._ticks[-1] - self._ticks[0])
 
-recording = True
 
 # -----------------------------
-# Main Loop
+# Detection
 # -----------------------------
-while True:
-    ret, frame = cap.read()
-    if not ret:
-        print("Camera read error")
-        break
+def load_cascades():
+    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    eye_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_eye.xml")
+    return face_cascade, eye_cascade
+
 
-    frame = cv2.resize(frame, (FRAME_WIDTH, FRAME_HEIGHT))
+def scaled_size(size, scale):
+    if not size[0] or not size[1]:
+        return (0, 0)
+    return (max(1, int(size[0] * scale)), max(1, int(size[1] * scale)))
 
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    blur = cv2.GaussianBlur(gray, (7, 7), 0)
 
-    # Threshold
-    _, thresh = cv2.threshold(blur, 40, 255, cv2.THRESH_BINARY_INV)
+def detect_eyes(gray, face_box, eye_cascade):
+    fx, fy, fw, fh = face_box
+    face_roi_gray = gray[fy:fy+fh, fx:fx+fw]
+    eyes = eye_cascade.detectMultiScale(face_roi_gray, minSize=EYE_MIN_SIZE,
+                                        maxSize=(max(EYE_MIN_SIZE[0], fw // 2), max(EYE_MIN_SIZE[1], fh // 2)))
+    return [(fx + int(ex), fy + int(ey), int(ew), int(eh)) for (ex, ey, ew, eh) in eyes]
 
-    # Detect faces
-    faces = face_cascade.detectMultiScale(gray, 1.3, 5)
 
+def detect_faces_and_eyes(gray, face_cascade, eye_cascade, scale=DETECT_SCALE):
+    """
+    Returns [(face_box, [eye_box, ...]), ...] with every box in frame coordinates.
+    Faces are found on `gray` downscaled by `scale`, eyes on the full-res crop.
+    """
+    if scale < 1.0:
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    else:
+        small, scale = gray, 1.0
+    faces = face_cascade.detectMultiScale(small, 1.3, 5, minSize=scaled_size(FACE_MIN_SIZE, scale),
+                                          maxSize=scaled_size(FACE_MAX_SIZE, scale))
+    height, width = gray.shape[:2]
+    detections = []
     for (fx, fy, fw, fh) in faces:
-        cv2.rectangle(frame, (fx, fy), (fx+fw, fy+fh), (0,255,0), 2)
+        face_box = expand_box((int(fx / scale), int(fy / scale), int(fw / scale), int(fh / scale)), 0, width, height)
+        detections.append((face_box, detect_eyes(gray, face_box, eye_cascade)))
+    return detections
+
+
+def expand_box(box, margin, width, height):
+    x, y, w, h = box
+    dx, dy = int(w * margin), int(h * margin)
+    x0, y0 = max(0, x - dx), max(0, y - dy)
+    x1, y1 = min(width, x + w + dx), min(height, y + h + dy)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def create_tracker(name):
+    """
+    OpenCV tracker by name from cv2 or cv2.legacy, or None if this build lacks it.
+    """
+    for module in (cv2, getattr(cv2, "legacy", None)):
+        factory = getattr(module, f"Tracker{name}_create", None) if module is not None else None
+        if factory is not None:
+            return factory()
+    return None
+
+
+class FaceTracker:
+    """
+    Track-then-detect face/eye detection.
+
+    A full-frame face scan runs every `redetect_interval` frames or as soon as
+    every track is lost. Between scans each face is searched only inside an
+    expanded ROI around its last box (or the box an OpenCV tracker propagated),
+    and eyes only inside the face. The cascade cost scales with searched area,
+    so a face covering a fraction of the frame makes most frames much cheaper.
+    """
+
+    def __init__(self, face_cascade, eye_cascade, redetect_interval=REDETECT_INTERVAL,
+                 margin=ROI_MARGIN, tracker_type=TRACKER_TYPE):
+        self.face_cascade = face_cascade
+        self.eye_cascade = eye_cascade
+        self.redetect_interval = max(1, redetect_interval)
+        self.margin = margin
+        self.tracker_type = tracker_type
+        self.tracks = []  # [(face_box, tracker_or_None)]
+        self.frames_since_scan = 0
+        self.full_scans = 0
+        self.roi_scans = 0
+        self.lost = 0
+
+        if tracker_type and create_tracker(tracker_type) is None:
+            print(f"Tracker {tracker_type} not available in this OpenCV build; using ROI search only")
+            self.tracker_type = None
+
+    def detect(self, gray, frame):
+        if self.tracks and self.frames_since_scan < self.redetect_interval:
+            detections = self._track(gray, frame)
+            if detections:
+                self.frames_since_scan += 1
+                return detections
+            self.lost += 1
+        return self._full_scan(gray, frame)
+
+    def _full_scan(self, gray, frame):
+        detections = detect_faces_and_eyes(gray, self.face_cascade, self.eye_cascade)
+        self.tracks = [(face_box, self._start_tracker(frame, face_box)) for face_box, _ in detections]
+        self.frames_since_scan = 0
+        self.full_scans += 1
+        return detections
+
+    def _start_tracker(self, frame, face_box):
+        if not self.tracker_type:
+            return None
+        tracker = create_tracker(self.tracker_type)
+        tracker.init(frame, face_box)
+        return tracker
+
+    def _track(self, gray, frame):
+        height, width = gray.shape[:2]
+        tracks = []
+        detections = []
+        for face_box, tracker in self.tracks:
+            if tracker is not None:
+                ok, box = tracker.update(frame)
+                if not ok:
+                    continue
+                face_box = expand_box(tuple(int(v) for v in box), 0, width, height)
+                if face_box[2] <= 0 or face_box[3] <= 0:
+                    continue
+            else:
+                face_box = self._search_roi(gray, face_box, width, height)
+                if face_box is None:
+                    continue
+            tracks.append((face_box, tracker))
+            detections.append((face_box, detect_eyes(gray, face_box, self.eye_cascade)))
+        self.roi_scans += 1
+        self.tracks = tracks
+        return detections
 
-        face_roi_gray = gray[fy:fy+fh, fx:fx+fw]
-        face_roi_color = frame[fy:fy+fh, fx:fx+fw]
+    def _search_roi(self, gray, face_box, width, height):
+        rx, ry, rw, rh = expand_box(face_box, self.margin, width, height)
+        # Skip scales far smaller than the face we are following.
+        min_side = max(1, int(min(face_box[2], face_box[3]) * 0.6))
+        faces = self.face_cascade.detectMultiScale(gray[ry:ry+rh, rx:rx+rw], 1.3, 5,
+                                                   minSize=(min_side, min_side), maxSize=FACE_MAX_SIZE)
+        if len(faces) == 0:
+            return None
+        # Keep the candidate closest to the previous box centre.
+        cx, cy = face_box[0] + face_box[2] / 2 - rx, face_box[1] + face_box[3] / 2 - ry
+        fx, fy, fw, fh = min(faces, key=lambda f: (f[0] + f[2] / 2 - cx) ** 2 + (f[1] + f[3] / 2 - cy) ** 2)
+        return int(rx + fx), int(ry + fy), int(fw), int(fh)
 
-        eyes = eye_cascade.detectMultiScale(face_roi_gray)
+
+class FrameDetector:
+    """
+    The per-frame detection step shared by the live pipeline and offline replay.
+    """
+
+    def __init__(self, tracking=TRACKING_MODE):
+        self.face_cascade, self.eye_cascade = load_cascades()
+        self.tracker = FaceTracker(self.face_cascade, self.eye_cascade) if tracking else None
+
+    def detect(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.tracker is not None:
+            return self.tracker.detect(gray, frame)
+        return detect_faces_and_eyes(gray, self.face_cascade, self.eye_cascade)
+
+
+def draw_overlay(frame, detections, fps, recording, timer):
+    for (fx, fy, fw, fh), eyes in detections:
+        cv2.rectangle(frame, (fx, fy), (fx+fw, fy+fh), (0,255,0), 2)
 
         for (ex, ey, ew, eh) in eyes:
-            eye_center_x = fx + ex + ew // 2
-            eye_center_y = fy + ey + eh // 2
+            eye_center_x = ex + ew // 2
+            eye_center_y = ey + eh // 2
 
             # Draw rectangle around eye
-            cv2.rectangle(face_roi_color, (ex, ey), (ex+ew, ey+eh), (255,0,0), 2)
+            cv2.rectangle(frame, (ex, ey), (ex+ew, ey+eh), (255,0,0), 2)
 
             # Draw crosshair
             cv2.line(frame, (eye_center_x, 0), (eye_center_x, FRAME_HEIGHT), (255,255,0), 1)
             cv2.line(frame, (0, eye_center_y), (FRAME_WIDTH, eye_center_y), (255,255,0), 1)
 
-            # Log data
-            if SAVE_LOG and recording:
-                current_time = time.time()
-                log_file.write(f"{current_time},{eye_center_x},{eye_center_y},{ew},{eh}\n")
-
-    # FPS calculation
-    current_time = time.time()
-    fps = int(1 / (current_time - prev_time)) if current_time != prev_time else 0
-    prev_time = current_time
-
     # UI Panel
     cv2.rectangle(frame, (0,0), (FRAME_WIDTH, 60), (50,50,50), -1)
     cv2.putText(frame, "Eye Tracking & Recording System", (10, 25),
@@ -115,37 +343,850 @@ while True:
     cv2.putText(frame, f"Status: {status_text}", (10, 50),
                 cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0,255,0), 2)
 
-    cv2.putText(frame, f"FPS: {fps}", (FRAME_WIDTH-120, 25),
+    cv2.putText(frame, f"FPS: {fps:.1f}", (FRAME_WIDTH-120, 25),
                 cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0,255,255), 2)
+    cv2.putText(frame, f"Detect: {timer.mean_ms('detect'):.0f} ms", (FRAME_WIDTH-180, 50),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,255), 1)
+
+
+# -----------------------------
+# Gaze aggregation
+# -----------------------------
+class GazeAggregator:
+    """
+    Per-session gaze statistics updated incrementally in O(1) time and memory
+    per frame: an eye-position density grid, a duration-weighted fixation grid,
+    fixation counts/durations (I-DT dispersion test over the running window)
+    and blinks (face visible while its eyes disappear for a short time).
+    """
+
+    def __init__(self, width=FRAME_WIDTH, height=FRAME_HEIGHT, cell=HEATMAP_CELL):
+        self.width, self.height, self.cell = width, height, cell
+        shape = ((height + cell - 1) // cell, (width + cell - 1) // cell)
+        self.heatmap = np.zeros(shape, np.int32)
+        self.fixation_map = np.zeros(shape, np.float32)
+        self.frames = 0
+        self.gaze_frames = 0
+        self.first_t = None
+        self.last_t = None
+
+        self.fixations = 0
+        self.fixation_time = 0.0
+        self.longest_fixation = 0.0
+        self._window = None  # [start_t, last_t, n, sum_x, sum_y, min_x, max_x, min_y, max_y]
+
+        self.blinks = 0
+        self._eyes_lost_at = None
+
+        self._overlay = None
+        self._overlay_age = HEATMAP_REFRESH
+
+    def update(self, t, detections):
+        self.frames += 1
+        self.first_t = t if self.first_t is None else self.first_t
+        self.last_t = t
+        if not detections:
+            # No face: neither a fixation nor a blink can be judged.
+            self._end_fixation()
+            self._eyes_lost_at = None
+            return
+
+        _, eyes = max(detections, key=lambda d: d[0][2] * d[0][3])
+        if not eyes:
+            self._end_fixation()
+            if self._eyes_lost_at is None:
+                self._eyes_lost_at = t
+            return
+        if self._eyes_lost_at is not None:
+            if BLINK_MIN_DURATION <= t - self._eyes_lost_at <= BLINK_MAX_DURATION:
+                self.blinks += 1
+            self._eyes_lost_at = None
+
+        x = sum(ex + ew / 2 for ex, _, ew, _ in eyes) / len(eyes)
+        y = sum(ey + eh / 2 for _, ey, _, eh in eyes) / len(eyes)
+        self.gaze_frames += 1
+        self.heatmap[self._cell(y, self.height), self._cell(x, self.width)] += 1
+        self._extend_fixation(t, x, y)
+
+    def _cell(self, v, limit):
+        return int(min(max(v, 0), limit - 1)) // self.cell
+
+    def _extend_fixation(self, t, x, y):
+        w = self._window
+        if w is not None:
+            min_x, max_x = min(w[5], x), max(w[6], x)
+            min_y, max_y = min(w[7], y), max(w[8], y)
+            if (max_x - min_x) + (max_y - min_y) <= FIXATION_DISPERSION:
+                w[1:] = [t, w[2] + 1, w[3] + x, w[4] + y, min_x, max_x, min_y, max_y]
+                return
+            self._end_fixation()
+        self._window = [t, t, 1, x, y, x, x, y, y]
+
+    def _end_fixation(self):
+        w, self._window = self._window, None
+        if w is None:
+            return
+        duration = w[1] - w[0]
+        if duration < FIXATION_MIN_DURATION:
+            return
+        self.fixations += 1
+        self.fixation_time += duration
+        self.longest_fixation = max(self.longest_fixation, duration)
+        self.fixation_map[self._cell(w[4] / w[2], self.height), self._cell(w[3] / w[2], self.width)] += duration
+
+    def draw(self, frame):
+        """
+        Blends the heatmap onto `frame`; the colour image is re-rendered only
+        every HEATMAP_REFRESH frames.
+        """
+        self._overlay_age += 1
+        if self._overlay is None or self._overlay_age >= HEATMAP_REFRESH:
+            self._overlay_age = 0
+            peak = self.heatmap.max()
+            if peak == 0:
+                self._overlay = None
+            else:
+                norm = (self.heatmap * (255.0 / peak)).astype(np.uint8)
+                norm = cv2.resize(norm, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_LINEAR)
+                self._overlay = (cv2.applyColorMap(norm, cv2.COLORMAP_JET), norm > 0)
+        if self._overlay is not None:
+            color, mask = self._overlay
+            frame[mask] = cv2.addWeighted(frame, 1.0 - HEATMAP_ALPHA, color, HEATMAP_ALPHA, 0)[mask]
+        cv2.putText(frame, f"Blinks: {self.blinks}  Fixations: {self.fixations}", (10, FRAME_HEIGHT - 15),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0,255,255), 2)
+
+    def summary(self):
+        self._end_fixation()
+        duration = (self.last_t - self.first_t) if self.frames > 1 else 0.0
+        return {
+            "frames": self.frames,
+            "gaze_frames": self.gaze_frames,
+            "duration_s": round(duration, 3),
+            "blinks": self.blinks,
+            "blinks_per_minute": round(self.blinks * 60.0 / duration, 2) if duration else 0.0,
+            "fixations": self.fixations,
+            "fixation_time_s": round(self.fixation_time, 3),
+            "mean_fixation_s": round(self.fixation_time / self.fixations, 3) if self.fixations else 0.0,
+            "longest_fixation_s": round(self.longest_fixation, 3),
+            "frame_size": [self.width, self.height],
+            "cell": self.cell,
+            "heatmap": self.heatmap.tolist(),
+            "fixation_map": np.round(self.fixation_map, 3).tolist(),
+        }
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, separators=(",", ":"))
+
+
+# -----------------------------
+# Pipeline stages
+# -----------------------------
+class CaptureThread(threading.Thread):
+    """
+    Reads camera frames as fast as the camera delivers them.
+    Items: (frame_index, monotonic_time, wall_time, frame)
+    """
+
+    def __init__(self, cap, out_queue, timer, stop_event):
+        super().__init__(daemon=True)
+        self.cap = cap
+        self.out_queue = out_queue
+        self.timer = timer
+        self.stop_event = stop_event
+        self.failed = False
+
+    def run(self):
+        index = 0
+        while not self.stop_event.is_set():
+            start = time.monotonic()
+            ret, frame = self.cap.read()
+            if not ret:
+                print("Camera read error")
+                self.failed = True
+                self.stop_event.set()
+                break
+            frame = cv2.resize(frame, (FRAME_WIDTH, FRAME_HEIGHT))
+            now = time.monotonic()
+            self.timer.add("capture", now - start)
+            self.out_queue.put((index, now, time.time(), frame))
+            index += 1
+
+
+class DetectionThread(threading.Thread):
+    """
+    Runs face/eye detection on the newest captured frames.
+    Items: (frame_index, monotonic_time, wall_time, frame, detections)
+    """
+
+    def __init__(self, in_queue, out_queue, timer, stop_event):
+        super().__init__(daemon=True)
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.timer = timer
+        self.stop_event = stop_event
+        self.detector = FrameDetector()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                index, captured_at, wall_time, frame = self.in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            start = time.monotonic()
+            detections = self.detector.detect(frame)
+            self.timer.add("detect", time.monotonic() - start)
+            self.out_queue.put((index, captured_at, wall_time, frame, detections))
+
+
+class WriterThread(threading.Thread):
+    """
+    Writes video frames off the UI thread through a drop-oldest queue, so a
+    disk stall drops frames instead of freezing the UI.
+    """
+
+    def __init__(self, video_writer, timer):
+        super().__init__(daemon=True)
+        self.video_writer = video_writer
+        self.timer = timer
+        self.frames = DropOldestQueue(WRITER_QUEUE_SIZE)
+        self._closing = threading.Event()
+
+    def write(self, frame):
+        if self.video_writer is not None:
+            self.frames.put(frame)
 
-    # Show
-    cv2.imshow("Eye Tracking", frame)
+    def close(self):
+        self._closing.set()
+        self.join()
 
-    # Save video
-    if RECORD_VIDEO and recording:
-        out.write(frame)
+    def run(self):
+        while True:
+            try:
+                frame = self.frames.get(timeout=0.05)
+            except queue.Empty:
+                if self._closing.is_set():
+                    break
+                continue
+            start = time.monotonic()
+            self.video_writer.write(frame)
+            self.timer.add("write", time.monotonic() - start)
 
-    # Keyboard
-    key = cv2.waitKey(1) & 0xFF
 
-    if key == ord("q"):
-        print("Program ended.")
-        break
+# -----------------------------
+# Binary gaze log
+# -----------------------------
+GAZE_MAGIC = b"EYEGAZE1"
+GAZE_HEADER_SIZE = 16
+
+
+def gaze_dtype(max_eyes=MAX_LOGGED_EYES):
+    """
+    One record per processed frame; eye boxes are (x, y, w, h) in frame pixels,
+    only the first `count` slots are valid.
+    """
+    return np.dtype([
+        ("frame", "<u8"),
+        ("t", "<f8"),        # time.monotonic() at capture
+        ("wall", "<f8"),     # time.time() at capture
+        ("count", "u1"),
+        ("eyes", "<i2", (max_eyes, 4)),
+    ])
+
+
+class GazeLog(threading.Thread):
+    """
+    Append-only binary gaze log.
+
+    `append` fills a row of a preallocated chunk under a lock (no formatting,
+    no syscalls); the thread writes out full chunks, and the partial chunk
+    every GAZE_FLUSH_INTERVAL seconds, so the hot loop never touches the disk.
+    """
+
+    def __init__(self, path, max_eyes=MAX_LOGGED_EYES, chunk=GAZE_LOG_CHUNK, flush_interval=GAZE_FLUSH_INTERVAL):
+        super().__init__(daemon=True)
+        self.path = path
+        self.dtype = gaze_dtype(max_eyes)
+        self.max_eyes = max_eyes
+        self.chunk_size = chunk
+        self.flush_interval = flush_interval
+        self.records = 0
+        self._lock = threading.Lock()
+        self._chunk = np.zeros(chunk, self.dtype)
+        self._used = 0
+        self._full = queue.Queue()
+        self._wake = threading.Event()
+        self._closing = threading.Event()
+        self._file = open(path, "wb")
+        self._file.write(GAZE_MAGIC + np.array([max_eyes, 0], "<u4").tobytes())
+
+    def append(self, frame_index, t, wall, eyes):
+        with self._lock:
+            row = self._chunk[self._used]
+            row["frame"] = frame_index
+            row["t"] = t
+            row["wall"] = wall
+            count = min(len(eyes), self.max_eyes)
+            row["count"] = count
+            if count:
+                row["eyes"][:count] = eyes[:count]
+            self._used += 1
+            if self._used == self.chunk_size:
+                self._full.put(self._chunk)
+                self._chunk = np.zeros(self.chunk_size, self.dtype)
+                self._used = 0
+                self._wake.set()
+
+    def close(self):
+        self._closing.set()
+        self._wake.set()
+        self.join()
+        self._file.close()
+
+    def run(self):
+        while not self._closing.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        while True:
+            try:
+                self._write(self._full.get_nowait())
+            except queue.Empty:
+                break
+        with self._lock:
+            pending = self._chunk[:self._used].copy()
+            self._chunk[:self._used] = 0
+            self._used = 0
+        if len(pending):
+            self._write(pending)
+        self._file.flush()
+
+    def _write(self, records):
+        self._file.write(records.tobytes())
+        self.records += len(records)
+
+
+def load_gaze_log(path):
+    """
+    Session records as a read-only structured array (memory-mapped, no parsing).
+    A trailing partial record from an interrupted session is ignored.
+    """
+    with open(path, "rb") as f:
+        header = f.read(GAZE_HEADER_SIZE)
+    if len(header) < GAZE_HEADER_SIZE or header[:8] != GAZE_MAGIC:
+        raise ValueError(f"{path} is not a gaze log")
+    dtype = gaze_dtype(int(np.frombuffer(header[8:12], "<u4")[0]))
+    count = (os.path.getsize(path) - GAZE_HEADER_SIZE) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=GAZE_HEADER_SIZE, shape=(count,))
+
+
+def gaze_eye_rows(records):
+    """
+    Flattens records to one row per eye: dict of equal-length column arrays.
+    """
+    counts = records["count"].astype(np.intp)
+    valid = np.arange(records["eyes"].shape[1])[None, :] < counts[:, None]
+    boxes = records["eyes"][valid].astype(np.int32)
+    return {
+        "frame": np.repeat(records["frame"], counts),
+        "t": np.repeat(records["t"], counts),
+        "wall": np.repeat(records["wall"], counts),
+        "x": boxes[:, 0] + boxes[:, 2] // 2,
+        "y": boxes[:, 1] + boxes[:, 3] // 2,
+        "width": boxes[:, 2],
+        "height": boxes[:, 3],
+    }
+
+
+def load_gaze_dataframe(path):
+    import pandas as pd
+    return pd.DataFrame(gaze_eye_rows(load_gaze_log(path)))
+
+
+def export_gaze_csv(path, csv_path):
+    """
+    Writes the legacy "Time,X,Y,Width,Height" eye log (eye centre, box size).
+    """
+    rows = gaze_eye_rows(load_gaze_log(path))
+    table = np.column_stack([rows["wall"], rows["x"], rows["y"], rows["width"], rows["height"]])
+    np.savetxt(csv_path, table, fmt=["%.6f", "%d", "%d", "%d", "%d"], delimiter=",",
+               header="Time,X,Y,Width,Height", comments="")
+    return len(table)
+
+
+# -----------------------------
+# Offline replay (headless)
+# -----------------------------
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+class ImageSequence:
+    """
+    cv2.VideoCapture-like reader over a directory of images in name order.
+    """
+
+    def __init__(self, directory):
+        self.paths = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        self._next = 0
+
+    def read(self):
+        while self._next < len(self.paths):
+            frame = cv2.imread(self.paths[self._next])
+            self._next += 1
+            if frame is not None:
+                return True, frame
+        return False, None
+
+    def release(self):
+        pass
+
+
+def open_source(source):
+    """
+    A camera index, a video file, or a directory of images.
+    """
+    if isinstance(source, int) or str(source).isdigit():
+        return cv2.VideoCapture(int(source))
+    if os.path.isdir(source):
+        return ImageSequence(source)
+    if not os.path.exists(source):
+        raise FileNotFoundError(source)
+    return cv2.VideoCapture(source)
+
+
+def replay(source, max_frames=None, tracking=TRACKING_MODE):
+    """
+    Runs the detection step over every frame of a recording, without a window
+    and without dropping frames, and returns a JSON-serialisable report.
+    """
+    cap = open_source(source) if isinstance(source, (str, int)) else source
+    detector = FrameDetector(tracking=tracking)
+    per_frame = []
+    started_at = time.perf_counter()
+    try:
+        while max_frames is None or len(per_frame) < max_frames:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frame = cv2.resize(frame, (FRAME_WIDTH, FRAME_HEIGHT))
+            start = time.perf_counter()
+            detections = detector.detect(frame)
+            per_frame.append({
+                "frame": len(per_frame),
+                "detect_ms": (time.perf_counter() - start) * 1000.0,
+                "faces": len(detections),
+                "eyes": sum(len(eyes) for _, eyes in detections),
+            })
+    finally:
+        cap.release()
+    elapsed = time.perf_counter() - started_at
+
+    detect_ms = np.array([f["detect_ms"] for f in per_frame]) if per_frame else np.zeros(1)
+    report = {
+        "source": str(source),
+        "frames": len(per_frame),
+        "elapsed_s": elapsed,
+        "fps": len(per_frame) / elapsed if elapsed > 0 else 0.0,
+        "detect_ms": {
+            "mean": float(detect_ms.mean()),
+            "p50": float(np.percentile(detect_ms, 50)),
+            "p95": float(np.percentile(detect_ms, 95)),
+            "max": float(detect_ms.max()),
+        },
+        "faces": sum(f["faces"] for f in per_frame),
+        "eyes": sum(f["eyes"] for f in per_frame),
+        "frames_with_face": sum(1 for f in per_frame if f["faces"]),
+        "settings": {
+            "frame_size": [FRAME_WIDTH, FRAME_HEIGHT],
+            "detect_scale": DETECT_SCALE,
+            "tracking": bool(tracking),
+            "redetect_interval": REDETECT_INTERVAL,
+        },
+        "per_frame": per_frame,
+    }
+    if detector.tracker is not None:
+        report["tracking"] = {
+            "full_scans": detector.tracker.full_scans,
+            "roi_scans": detector.tracker.roi_scans,
+            "lost": detector.tracker.lost,
+        }
+    return report
+
+
+# -----------------------------
+# Multi-source mode (one process per source)
+# -----------------------------
+def source_tag(position, source):
+    if str(source).isdigit():
+        return f"{position}_cam{source}"
+    name = os.path.splitext(os.path.basename(os.path.normpath(str(source))))[0]
+    return f"{position}_" + "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
+
+
+def live_frames(cap, stop_event):
+    """
+    Newest camera frames via CaptureThread (drop-oldest), for live sources.
+    """
+    frame_queue = DropOldestQueue(FRAME_QUEUE_SIZE)
+    local_stop = threading.Event()
+    capture = CaptureThread(cap, frame_queue, StageTimer(), local_stop)
+    capture.start()
+    try:
+        while not stop_event.is_set() and not local_stop.is_set():
+            try:
+                index, captured_at, wall_time, frame = frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            yield frame, captured_at, wall_time, frame_queue.dropped
+    finally:
+        local_stop.set()
+        capture.join(timeout=1.0)
+
+
+def file_frames(cap, stop_event):
+    """
+    Every frame of a video file / image directory, in order.
+    """
+    while not stop_event.is_set():
+        ret, frame = cap.read()
+        if not ret:
+            return
+        yield cv2.resize(frame, (FRAME_WIDTH, FRAME_HEIGHT)), time.monotonic(), time.time(), 0
+
+
+def source_worker(tag, source, output_dir, timestamp, stats_queue, stop_event):
+    """
+    Runs capture, detection and recording for one source in its own process,
+    reporting stats to the coordinator every STATS_INTERVAL seconds.
+    """
+    cv2.setNumThreads(WORKER_CV_THREADS)
+    live = str(source).isdigit()
+    cap = open_source(source)
+    if live:
+        cap.set(3, FRAME_WIDTH)
+        cap.set(4, FRAME_HEIGHT)
+    detector = FrameDetector()
+    timer = StageTimer()
+    fps_meter = FPSMeter(window=STATS_INTERVAL)
+
+    video_path = os.path.join(output_dir, f"eye_record_{timestamp}_{tag}.avi")
+    log_path = os.path.join(output_dir, f"eye_log_{timestamp}_{tag}.gaze")
+    summary_path = os.path.join(output_dir, f"eye_summary_{timestamp}_{tag}.json")
+    aggregator = GazeAggregator()
+    writer = WriterThread(
+        cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*"XVID"), 20.0, (FRAME_WIDTH, FRAME_HEIGHT))
+        if RECORD_VIDEO else None, timer)
+    writer.start()
+    gaze_log = GazeLog(log_path) if SAVE_LOG else None
+    if gaze_log is not None:
+        gaze_log.start()
+
+    stats = {"source": str(source), "tag": tag, "status": "running", "frames": 0, "faces": 0, "eyes": 0,
+             "dropped": 0, "fps": 0.0, "avg_fps": 0.0, "detect_ms": 0.0, "pid": os.getpid()}
+    frames = live_frames(cap, stop_event) if live else file_frames(cap, stop_event)
+    started_at = last_report = time.monotonic()
+    try:
+        for frame, captured_at, wall_time, dropped in frames:
+            start = time.monotonic()
+            detections = detector.detect(frame)
+            timer.add("detect", time.monotonic() - start)
+            fps = fps_meter.tick()
+            aggregator.update(captured_at, detections)
+            if SHOW_HEATMAP:
+                aggregator.draw(frame)
+            draw_overlay(frame, detections, fps, True, timer)
+            writer.write(frame)
+            eyes = [eye for _, face_eyes in detections for eye in face_eyes]
+            if gaze_log is not None:
+                gaze_log.append(stats["frames"], captured_at, wall_time, eyes)
+            stats["frames"] += 1
+            stats["faces"] += len(detections)
+            stats["eyes"] += len(eyes)
+            stats["dropped"] = dropped
+            if time.monotonic() - last_report >= STATS_INTERVAL:
+                stats.update(fps=fps, avg_fps=stats["frames"] / (time.monotonic() - started_at),
+                             detect_ms=timer.mean_ms("detect"), updated_at=time.time())
+                stats_queue.put(dict(stats))
+                last_report = time.monotonic()
+        stats["status"] = "stopped" if stop_event.is_set() else "finished"
+    except Exception as e:
+        stats.update(status="error", error=repr(e))
+        raise
+    finally:
+        writer.close()
+        cap.release()
+        if writer.video_writer is not None:
+            writer.video_writer.release()
+        if gaze_log is not None:
+            gaze_log.close()
+        if SAVE_SUMMARY:
+            aggregator.save(summary_path)
+        elapsed = time.monotonic() - started_at
+        stats.update(avg_fps=stats["frames"] / elapsed if elapsed > 0 else 0.0, elapsed_s=elapsed,
+                     detect_ms=timer.mean_ms("detect"), updated_at=time.time(), blinks=aggregator.blinks,
+                     fixations=aggregator.fixations, video=video_path if RECORD_VIDEO else None,
+                     log=log_path if SAVE_LOG else None, summary=summary_path if SAVE_SUMMARY else None)
+        stats_queue.put(dict(stats))
+    return stats
+
+
+def ignore_interrupt():
+    # Ctrl+C reaches the whole process group; only the coordinator handles it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def print_health(latest, started_at, final=False):
+    """
+    Periodic report: current (windowed) FPS of running sources. Final report:
+    whole-run FPS (frames / elapsed) of every source and their sum.
+    """
+    now = time.time()
+    total_fps = 0.0
+    print(f"--- {'final' if final else f'{now - started_at:.0f}s'} ---")
+    for tag, stats in sorted(latest.items()):
+        status = stats["status"]
+        if status == "running" and now - stats.get("updated_at", started_at) > STALL_TIMEOUT:
+            status = "stalled"
+        fps = stats.get("avg_fps", 0.0) if final else stats["fps"]
+        if final or status == "running":
+            total_fps += fps
+        print(f"  {tag:<24}{status:<10}{fps:>7.1f} fps {stats['detect_ms']:>7.1f} ms  "
+              f"frames {stats['frames']:<7} eyes {stats['eyes']:<7} dropped {stats['dropped']}")
+    label = "aggregate (whole run)" if final else "total"
+    print(f"  {label} {total_fps:.1f} fps across {len(latest)} sources")
+
+
+def run_multi(sources):
+    """
+    Coordinator: one worker process per source, aggregating their FPS and
+    health. Ctrl+C stops every worker and flushes its outputs.
+    """
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    tags = [source_tag(i, source) for i, source in enumerate(sources)]
+
+    context = multiprocessing.get_context("spawn")
+    manager = SyncManager(ctx=context)
+    manager.start(ignore_interrupt)
+    stats_queue = manager.Queue()
+    stop_event = manager.Event()
+    latest = {tag: {"source": str(source), "tag": tag, "status": "starting", "frames": 0, "faces": 0,
+                    "eyes": 0, "dropped": 0, "fps": 0.0, "detect_ms": 0.0}
+              for tag, source in zip(tags, sources)}
+    started_at = time.time()
+
+    with ProcessPoolExecutor(max_workers=len(sources), mp_context=context,
+                             initializer=ignore_interrupt) as pool:
+        futures = {
+            pool.submit(source_worker, tag, source, OUTPUT_DIR, timestamp, stats_queue, stop_event): tag
+            for tag, source in zip(tags, sources)
+        }
+        print(f"Tracking {len(sources)} sources; Ctrl+C to stop")
+        # Turn Ctrl+C into a flag: a KeyboardInterrupt raised inside a manager
+        # proxy call would leave its connection unusable.
+        interrupted = threading.Event()
+        previous_handler = signal.signal(signal.SIGINT, lambda *_: interrupted.set())
+        next_report = time.monotonic() + STATS_INTERVAL
+        try:
+            while not all(future.done() for future in futures):
+                if interrupted.is_set() and not stop_event.is_set():
+                    print("Stopping workers...")
+                    stop_event.set()
+                try:
+                    stats = stats_queue.get(timeout=0.2)
+                    latest[stats["tag"]] = stats
+                except queue.Empty:
+                    pass
+                if time.monotonic() >= next_report:
+                    print_health(latest, started_at)
+                    next_report = time.monotonic() + STATS_INTERVAL
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+
+        for future, tag in futures.items():
+            try:
+                latest[tag] = future.result()
+            except Exception as e:
+                latest[tag].update(status="error", error=repr(e))
+    manager.shutdown()
+
+    print_health(latest, started_at, final=True)
+    for tag, stats in sorted(latest.items()):
+        if stats.get("error"):
+            print(f"  {tag}: {stats['error']}")
+        for key in ("video", "log", "summary"):
+            if stats.get(key):
+                print(f"  {tag}: saved {key} {stats[key]}")
+    return latest
 
-    if key == ord("r"):
-        recording = not recording
-        print("Recording:", recording)
 
 # -----------------------------
-# Cleanup
+# Main Loop
 # -----------------------------
-cap.release()
-out.release()
+def main():
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
+    # -----------------------------
+    # Open Camera
+    # -----------------------------
+    cap = cv2.VideoCapture(CAMERA_INDEX)
+    cap.set(3, FRAME_WIDTH)
+    cap.set(4, FRAME_HEIGHT)
+
+    # -----------------------------
+    # Video Writer / Log file
+    # -----------------------------
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    video_path = os.path.join(OUTPUT_DIR, f"eye_record_{timestamp}.avi")
+    log_path = os.path.join(OUTPUT_DIR, f"eye_log_{timestamp}.gaze")
+    summary_path = os.path.join(OUTPUT_DIR, f"eye_summary_{timestamp}.json")
+
+    out = None
+    if RECORD_VIDEO:
+        fourcc = cv2.VideoWriter_fourcc(*"XVID")
+        out = cv2.VideoWriter(video_path, fourcc, 20.0, (FRAME_WIDTH, FRAME_HEIGHT))
+
+    gaze_log = None
+    if SAVE_LOG:
+        gaze_log = GazeLog(log_path)
+        gaze_log.start()
+
+    # -----------------------------
+    # Start pipeline
+    # -----------------------------
+    timer = StageTimer()
+    fps_meter = FPSMeter()
+    stop_event = threading.Event()
+    frame_queue = DropOldestQueue(FRAME_QUEUE_SIZE)
+    result_queue = DropOldestQueue(RESULT_QUEUE_SIZE)
+
+    capture = CaptureThread(cap, frame_queue, timer, stop_event)
+    detection = DetectionThread(frame_queue, result_queue, timer, stop_event)
+    writer = WriterThread(out, timer)
+    for thread in (capture, detection, writer):
+        thread.start()
+
+    print("Eye Tracking Started")
+    print("Press Q to Quit | R to Start/Stop Recording | H to Show/Hide Heatmap")
+
+    aggregator = GazeAggregator()
+    show_heatmap = SHOW_HEATMAP
+    recording = True
+    frames_shown = 0
+    started_at = time.monotonic()
+
+    while not stop_event.is_set():
+        try:
+            index, captured_at, wall_time, frame, detections = result_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+        fps = fps_meter.tick()
+        if recording:
+            aggregator.update(captured_at, detections)
+        if show_heatmap:
+            aggregator.draw(frame)
+        draw_overlay(frame, detections, fps, recording, timer)
+
+        # Show
+        cv2.imshow("Eye Tracking", frame)
+        frames_shown += 1
+        timer.add("end_to_end", time.monotonic() - captured_at)
+
+        # Save video / log
+        if recording:
+            writer.write(frame)
+            if gaze_log is not None:
+                gaze_log.append(index, captured_at, wall_time, [eye for _, eyes in detections for eye in eyes])
+
+        # Keyboard
+        key = cv2.waitKey(1) & 0xFF
+
+        if key == ord("q"):
+            print("Program ended.")
+            break
+
+        if key == ord("r"):
+            recording = not recording
+            print("Recording:", recording)
+
+        if key == ord("h"):
+            show_heatmap = not show_heatmap
+
+    # -----------------------------
+    # Cleanup
+    # -----------------------------
+    stop_event.set()
+    capture.join(timeout=1.0)
+    detection.join(timeout=1.0)
+    writer.close()
+    cap.release()
+    if out is not None:
+        out.release()
+
+    if gaze_log is not None:
+        gaze_log.close()
+
+    cv2.destroyAllWindows()
+
+    elapsed = time.monotonic() - started_at
+    print(f"Average FPS: {frames_shown / elapsed:.1f} ({frames_shown} frames in {elapsed:.1f}s)")
+    print(f"Dropped frames: capture->detect {frame_queue.dropped}, detect->display {result_queue.dropped}, "
+          f"video writer {writer.frames.dropped}")
+    if detection.detector.tracker is not None:
+        tracker = detection.detector.tracker
+        print(f"Tracking: {tracker.full_scans} full scans, {tracker.roi_scans} ROI frames, {tracker.lost} lost tracks")
+    for stage, stats in timer.summary().items():
+        print(f"  {stage:<10} mean {stats['mean_ms']:.1f} ms  p95 {stats['p95_ms']:.1f} ms")
 
-if SAVE_LOG:
-    log_file.close()
+    if RECORD_VIDEO:
+        print("Saved video:", video_path)
+    if SAVE_LOG:
+        print(f"Saved log: {log_path} ({gaze_log.records} frames)")
+    if SAVE_SUMMARY:
+        aggregator.save(summary_path)
+        print(f"Saved summary: {summary_path} ({aggregator.blinks} blinks, {aggregator.fixations} fixations)")
 
-cv2.destroyAllWindows()
 
-print("Saved video:", video_path)
-print("Saved log:", log_path)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Eye tracking & recording system.")
+    parser.add_argument("--export-csv", metavar="GAZE_LOG",
+                        help="convert a .gaze log to CSV next to it and exit")
+    parser.add_argument("--replay", metavar="SOURCE",
+                        help="run detection headless over a video file or image directory and exit")
+    parser.add_argument("--report", metavar="JSON", help="write the replay report here (default: stdout)")
+    parser.add_argument("--max-frames", type=int, default=None)
+    parser.add_argument("--no-tracking", action="store_true", help="full-frame detection on every frame")
+    parser.add_argument("--sources", nargs="+", metavar="SOURCE",
+                        help="multi-source mode: camera indexes, video files or image directories, "
+                             "one worker process each (headless)")
+    args = parser.parse_args()
+    if args.sources:
+        run_multi(args.sources)
+        sys.exit(0)
+    if args.replay:
+        report = replay(args.replay, args.max_frames, tracking=TRACKING_MODE and not args.no_tracking)
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2)
+        else:
+            json.dump({k: v for k, v in report.items() if k != "per_frame"}, sys.stdout, indent=2)
+            print()
+        print(f"{report['frames']} frames, {report['fps']:.1f} FPS, detect mean {report['detect_ms']['mean']:.1f} ms, "
+              f"p95 {report['detect_ms']['p95']:.1f} ms", file=sys.stderr)
+        sys.exit(0)
+    if args.export_csv:
+        csv_path = os.path.splitext(args.export_csv)[0] + ".csv"
+        print(f"Exported {export_gaze_csv(args.export_csv, csv_path)} eye rows to {csv_path}")
+        sys.exit(0)
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import json
+import sys
+import cv2
+import numpy as np
+
+from eye_tracing_recording_project import FRAME_WIDTH, FRAME_HEIGHT, TRACKING_MODE, replay
+
+# -----------------------------
+# SETTINGS
+# -----------------------------
+SYNTHETIC_FRAMES = 120
+DEFAULT_REPEAT = 3
+MAX_SLOWDOWN = 0.15         # fail if FPS drops more than 15% below the baseline
+MAX_DETECTION_DRIFT = 0.05  # fail if eye detections change by more than 5%
+
+
+def draw_face(size):
+    """
+    Procedural frontal face (gray) that the stock Haar face and eye cascades
+    detect: bright oval, dark brows, eye sockets with irises, nose, mouth.
+    """
+    img = np.full((size, size), 90, np.uint8)
+    c = size // 2
+    cv2.ellipse(img, (c, int(c * 1.05)), (int(size * 0.36), int(size * 0.47)), 0, 0, 360, 200, -1)
+    for side in (-1, 1):
+        ex = c + side * int(size * 0.17)
+        cv2.ellipse(img, (ex, int(size * 0.36)), (int(size * 0.1), int(size * 0.03)), 0, 0, 360, 60, -1)
+        cv2.ellipse(img, (ex, int(size * 0.45)), (int(size * 0.09), int(size * 0.05)), 0, 0, 360, 110, -1)
+        cv2.ellipse(img, (ex, int(size * 0.45)), (int(size * 0.065), int(size * 0.03)), 0, 0, 360, 235, -1)
+        cv2.circle(img, (ex, int(size * 0.45)), int(size * 0.028), 20, -1)
+    cv2.line(img, (c, int(size * 0.48)), (c - int(size * 0.03), int(size * 0.64)), 150, max(1, size // 60))
+    cv2.ellipse(img, (c, int(size * 0.66)), (int(size * 0.06), int(size * 0.02)), 0, 0, 360, 120, -1)
+    cv2.ellipse(img, (c, int(size * 0.78)), (int(size * 0.12), int(size * 0.03)), 0, 0, 360, 90, -1)
+    return cv2.GaussianBlur(img, (0, 0), size / 100)
+
+
+class SyntheticClip:
+    """
+    Deterministic clip for when no recording is at hand: a textured
+    background with a procedural face drifting across it, leaving the frame
+    for a stretch every FACE_ABSENT_EVERY frames. It exercises the full-scan,
+    ROI tracking and lost-track paths, and yields non-zero face/eye counts
+    for the detection-drift gate.
+    """
+
+    FACE_ABSENT_EVERY = 45
+    FACE_ABSENT_FOR = 7
+
+    def __init__(self, frames, seed=0):
+        # Pre-rendered so generating frames is not part of the measured time.
+        rng = np.random.default_rng(seed)
+        background = cv2.GaussianBlur((rng.random((FRAME_HEIGHT, FRAME_WIDTH)) * 255).astype(np.uint8), (0, 0), 3)
+        background = cv2.convertScaleAbs(background, alpha=0.5, beta=40)
+        self.frames = []
+        for i in range(frames):
+            frame = background.copy()
+            if i % self.FACE_ABSENT_EVERY < self.FACE_ABSENT_EVERY - self.FACE_ABSENT_FOR:
+                size = int(150 + 30 * np.sin(i / 15.0))
+                x = int((FRAME_WIDTH - size) * (0.5 + 0.4 * np.sin(i / 25.0)))
+                y = int((FRAME_HEIGHT - size) * (0.5 + 0.3 * np.cos(i / 30.0)))
+                frame[y:y + size, x:x + size] = draw_face(size)
+            self.frames.append(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+
+    def read(self):
+        if not self.frames:
+            return False, None
+        return True, self.frames.pop(0)
+
+    def release(self):
+        pass
+
+
+def run_source(source, repeat, max_frames, tracking):
+    """
+    Replays a source `repeat` times and keeps the median-FPS run.
+    """
+    runs = []
+    for _ in range(repeat):
+        clip = SyntheticClip(max_frames or SYNTHETIC_FRAMES) if source == "synthetic" else source
+        report = replay(clip, max_frames, tracking=tracking)
+        runs.append(report)
+    report = sorted(runs, key=lambda r: r["fps"])[len(runs) // 2]
+    return {
+        "frames": report["frames"],
+        "fps": report["fps"],
+        "detect_mean_ms": report["detect_ms"]["mean"],
+        "detect_p95_ms": report["detect_ms"]["p95"],
+        "faces": report["faces"],
+        "eyes": report["eyes"],
+        "tracking": report.get("tracking"),
+    }
+
+
+def compare(results, baseline, max_slowdown, max_drift):
+    failures = []
+    for source, result in results.items():
+        base = baseline.get(source)
+        if base is None:
+            continue
+        if result["fps"] < base["fps"] * (1.0 - max_slowdown):
+            failures.append(f"{source}: FPS {result['fps']:.1f} < baseline {base['fps']:.1f} "
+                            f"(-{max_slowdown:.0%} allowed)")
+        if abs(result["eyes"] - base["eyes"]) > max(1, base["eyes"] * max_drift):
+            failures.append(f"{source}: eye detections {result['eyes']} vs baseline {base['eyes']}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the eye-tracking detection loop and gate regressions.")
+    parser.add_argument("sources", nargs="*", default=["synthetic"],
+                        help="video files or image directories (default: a synthetic clip with a moving face)")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--max-frames", type=int, default=None)
+    parser.add_argument("--no-tracking", action="store_true")
+    parser.add_argument("--baseline", help="JSON from a previous --save-baseline run to compare against")
+    parser.add_argument("--save-baseline", metavar="JSON")
+    parser.add_argument("--max-slowdown", type=float, default=MAX_SLOWDOWN)
+    parser.add_argument("--max-detection-drift", type=float, default=MAX_DETECTION_DRIFT)
+    args = parser.parse_args()
+
+    tracking = TRACKING_MODE and not args.no_tracking
+    results = {}
+    print(f"{'source':<40}{'frames':>8}{'fps':>8}{'mean ms':>10}{'p95 ms':>10}{'faces':>8}{'eyes':>8}")
+    for source in args.sources:
+        result = run_source(source, args.repeat, args.max_frames, tracking)
+        results[source] = result
+        print(f"{source[-40:]:<40}{result['frames']:>8}{result['fps']:>8.1f}{result['detect_mean_ms']:>10.1f}"
+              f"{result['detect_p95_ms']:>10.1f}{result['faces']:>8}{result['eyes']:>8}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved baseline:", args.save_baseline)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = compare(results, baseline, args.max_slowdown, args.max_detection_drift)
+        for failure in failures:
+            print("REGRESSION:", failure)
+        if failures:
+            sys.exit(1)
+        print("No regressions against", args.baseline)
+
+
+if __name__ == "__main__":
+    main()
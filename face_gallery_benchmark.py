@@ -0,0 +1,80 @@
+import argparse
+import time
+import numpy as np
+
+from face_save_project import FaceGallery
+
+# -----------------------------
+# SETTINGS
+# -----------------------------
+DEFAULT_PEOPLE = 20000
+EMBEDDINGS_PER_PERSON = 5
+EMBEDDING_SIZE = 512
+QUERY_COUNT = 200
+POSE_NOISE = 0.35
+
+
+def build_gallery(people, dim, seed):
+    """
+    Synthetic gallery: one random identity center per person plus
+    per-pose noise, similar to the five-direction registration flow.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(people, dim)).astype(np.float32)
+    gallery = FaceGallery()
+    gallery.add_many(
+        (f"person_{p}", centers[p] + POSE_NOISE * rng.normal(size=(EMBEDDINGS_PER_PERSON, dim)))
+        for p in range(people)
+    )
+    queries = centers[rng.integers(0, people, QUERY_COUNT)] + POSE_NOISE * rng.normal(size=(QUERY_COUNT, dim))
+    return gallery, queries
+
+
+def time_search(gallery, queries, top_k, nprobe):
+    results = []
+    timings = []
+    for q in queries:
+        start = time.perf_counter()
+        results.append(gallery.search(q, top_k=top_k, nprobe=nprobe))
+        timings.append(time.perf_counter() - start)
+    return results, np.array(timings) * 1000.0
+
+
+def recall(approx, exact, k):
+    hits = 0
+    for a, e in zip(approx, exact):
+        hits += len({n for n, _ in a[:k]} & {n for n, _ in e[:k]})
+    return hits / (len(exact) * k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare exact and IVF face gallery search.")
+    parser.add_argument("--people", type=int, default=DEFAULT_PEOPLE)
+    parser.add_argument("--dim", type=int, default=EMBEDDING_SIZE)
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"Building gallery: {args.people} people x {EMBEDDINGS_PER_PERSON} embeddings, dim {args.dim}")
+    gallery, queries = build_gallery(args.people, args.dim, args.seed)
+
+    start = time.perf_counter()
+    gallery.build_ivf(args.nlist)
+    print(f"IVF training ({args.nlist} lists): {time.perf_counter() - start:.2f}s")
+
+    exact, exact_ms = time_search(gallery, queries, args.top_k, None)
+    print(f"{'mode':<12}{'recall@1':>10}{'recall@k':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    print(f"{'exact':<12}{1.0:>10.3f}{1.0:>10.3f}{exact_ms.mean():>10.3f}"
+          f"{np.percentile(exact_ms, 50):>10.3f}{np.percentile(exact_ms, 99):>10.3f}")
+
+    for nprobe in args.nprobe:
+        approx, ann_ms = time_search(gallery, queries, args.top_k, nprobe)
+        label = f"nprobe={nprobe}"
+        print(f"{label:<12}{recall(approx, exact, 1):>10.3f}{recall(approx, exact, args.top_k):>10.3f}{ann_ms.mean():>10.3f}"
+              f"{np.percentile(ann_ms, 50):>10.3f}{np.percentile(ann_ms, 99):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
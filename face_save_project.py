@@ -1,5 +1,6 @@
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.responses import JSONResponse
+from typing import List
 from deepface import DeepFace
 from PIL import Image
 import numpy as np
@@ -7,6 +8,20 @@ import io
 import os
 import cv2
 import json
+import glob
+import time
+import uuid
+import sqlite3
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from contextlib import closing, contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process locking only
+    fcntl = None
 
 app = FastAPI(title="Face Recognition API", version="1.0")
 
@@ -21,9 +36,1208 @@ os.makedirs(SAVE_DIR, exist_ok=True)
 # -------------------------------
 directions = ["Turn Right", "Turn Left", "Look Up", "Look Down", "Look Center"]
 
-current_name = None
-current_embeddings = []
-current_step = 0
+# -------------------------------
+# Embedding model (registration and recognition must match)
+# -------------------------------
+EMBEDDING_MODEL = "Facenet512"
+RECOGNITION_THRESHOLD = 0.65
+# Output width of each DeepFace model; vectors of any other width (e.g. legacy
+# 128-d Facenet files) cannot be compared with EMBEDDING_MODEL queries.
+EMBEDDING_SIZES = {
+    "VGG-Face": 4096, "Facenet": 128, "Facenet512": 512, "OpenFace": 128, "DeepFace": 4096,
+    "DeepID": 160, "ArcFace": 512, "Dlib": 128, "SFace": 128, "GhostFaceNet": 512,
+}
+EMBEDDING_SIZE = EMBEDDING_SIZES.get(EMBEDDING_MODEL)
+
+# -------------------------------
+# Inference: models preloaded at startup, run off the event loop
+# -------------------------------
+PRELOAD_MODELS = [EMBEDDING_MODEL]
+DETECTOR_BACKEND = "opencv"
+MAX_DETECT_SIDE = int(os.environ.get("FACE_MAX_DETECT_SIDE", "1024"))
+INFERENCE_WORKERS = int(os.environ.get("FACE_INFERENCE_WORKERS", "1"))
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="deepface")
+model_status = {"ready": False, "models": {}, "error": None}
+
+# -------------------------------
+# Haar-cascade pre-filter: reject faceless / off-frame uploads and crop to the
+# face before DeepFace. DETECTOR_BACKEND "opencv" runs the same frontal cascade
+# on the decoded image (scale factor 1.1, 10 neighbors, the cascade's 24 px
+# window as minimum). With the default PREFILTER_MIN_FACE the pre-filter scans
+# that same image with the same scale factor and fewer neighbors, so it does
+# not reject faces DeepFace would detect. A larger PREFILTER_MIN_FACE (px in
+# the decoded image) scans a copy downscaled until that size fills the
+# cascade window: faster, but smaller faces are then rejected. Faces cut off
+# by the border are rejected by policy (PREFILTER_REJECT_OFF_FRAME); DeepFace
+# would still embed them.
+# -------------------------------
+PREFILTER_ENABLED = os.environ.get("FACE_PREFILTER", "1") == "1"
+PREFILTER_CASCADE = "haarcascade_frontalface_default.xml"
+PREFILTER_SCALE_FACTOR = 1.1
+PREFILTER_MIN_NEIGHBORS = 3
+PREFILTER_MIN_FACE = int(os.environ.get("FACE_PREFILTER_MIN_FACE", "0"))  # px; 0 = cascade window
+PREFILTER_EDGE = 2             # px on the scanned image; faces touching the border count as off-frame
+PREFILTER_MARGIN = 0.4         # crop margin, fraction of face size per side
+PREFILTER_REJECT_OFF_FRAME = os.environ.get("FACE_PREFILTER_REJECT_OFF_FRAME", "1") == "1"
+
+# -------------------------------
+# Approximate search for large galleries (IVF)
+# -------------------------------
+ANN_ENABLED = os.environ.get("FACE_ANN", "0") == "1"
+ANN_MIN_SIZE = int(os.environ.get("FACE_ANN_MIN_SIZE", "10000"))
+ANN_NLIST = int(os.environ.get("FACE_ANN_NLIST", "256"))
+ANN_NPROBE = int(os.environ.get("FACE_ANN_NPROBE", "8"))
+ANN_INDEX_PATH = os.path.join(SAVE_DIR, "gallery_ivf.npz")
+
+# -------------------------------
+# Embedding store compaction / names
+# -------------------------------
+COMPACT_DEAD_RATIO = 0.25
+MAX_NAME_LENGTH = 100
+
+# -------------------------------
+# Registration sessions (shared by all workers on this host)
+# -------------------------------
+SESSION_DB_PATH = os.path.join(SAVE_DIR, "sessions.db")
+SESSION_TTL = int(os.environ.get("FACE_SESSION_TTL", "600"))
+MAX_SESSIONS = int(os.environ.get("FACE_MAX_SESSIONS", "1000"))
+
+
+# =========================================================
+# APPROXIMATE NEAREST-NEIGHBOR (IVF) INDEX
+# =========================================================
+class IVFIndex:
+    """
+    Inverted-file index: vectors are bucketed by their nearest k-means
+    centroid, and a query only scores the vectors in its nprobe closest
+    buckets. Higher nprobe means better recall and slower search.
+    """
+
+    def __init__(self, centroids):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+
+    @classmethod
+    def train(cls, vectors, nlist, iterations=10, seed=0):
+        """
+        Spherical k-means on L2-normalized vectors.
+        """
+        rng = np.random.default_rng(seed)
+        nlist = max(1, min(nlist, len(vectors)))
+        # A few dozen points per centroid are enough to place it
+        if len(vectors) > nlist * 64:
+            vectors = vectors[rng.choice(len(vectors), nlist * 64, replace=False)]
+        index = cls(vectors[rng.choice(len(vectors), nlist, replace=False)].copy())
+        for _ in range(iterations):
+            assignments = index.assign(vectors)
+            order = np.argsort(assignments, kind="stable")
+            used, offsets = np.unique(assignments[order], return_index=True)
+            sums = np.add.reduceat(vectors[order], offsets, axis=0)
+            index.centroids[used] = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        return index
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path)["centroids"])
+
+    def save(self, path):
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids)
+        os.replace(tmp_path, path)
+
+    def assign(self, vectors, chunk_size=8192):
+        assignments = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = vectors[start:start + chunk_size]
+            assignments[start:start + len(chunk)] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return assignments
+
+    def probe(self, query, nprobe):
+        nprobe = max(1, min(nprobe, len(self.centroids)))
+        return np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+
+    def inverted_lists(self, assignments):
+        """
+        Returns (rows sorted by bucket, bucket offsets into that array).
+        """
+        rows = np.argsort(assignments, kind="stable")
+        offsets = np.searchsorted(assignments[rows], np.arange(len(self.centroids) + 1))
+        return rows, offsets
+
+
+# =========================================================
+# EMBEDDING STORE (APPEND-ONLY, MEMORY-MAPPED)
+# =========================================================
+class EmbeddingStore:
+    """
+    All enrolled embeddings in one append-only float32 file. Beside it are an
+    append-only names file (one name per line; the line number is the name's
+    id) and a binary index of fixed-width (id, start, count) records. The
+    latest record for an id wins, and "count" 0 is a tombstone. Rows not
+    referenced by a live record are reclaimed by compact().
+
+    The index is read with numpy, so loading it costs milliseconds even for
+    large galleries. starts[i] and counts[i] hold the live range of name id i.
+
+    Writers hold an exclusive file lock, readers a shared one, so several
+    worker processes can use the same directory.
+    """
+
+    RECORD = np.dtype([("id", "<i4"), ("count", "<i4"), ("start", "<i8")])
+
+    def __init__(self, directory, expected_dim=None):
+        self.expected_dim = expected_dim
+        self.data_path = os.path.join(directory, "embeddings.f32")
+        self.names_path = os.path.join(directory, "embeddings_names.txt")
+        self.index_path = os.path.join(directory, "embeddings_index.bin")
+        self.legacy_index_path = os.path.join(directory, "embeddings_index.jsonl")
+        self.meta_path = os.path.join(directory, "embeddings_meta.json")
+        self.lock_path = os.path.join(directory, "embeddings.lock")
+        self.dim = None
+        self.generation = 0
+        self._reset_index()
+
+    def _reset_index(self):
+        self.names = []
+        self.name_ids = {}
+        self.starts = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self._names_offset = 0
+        self._index_offset = 0
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        with open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def refresh(self):
+        """
+        Reads names and index records appended since the last call.
+        Returns True when any live range changed.
+        """
+        with self._locked():
+            return self._refresh()
+
+    def _refresh(self):
+        changed = False
+        meta = {}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        if meta.get("generation", 0) != self.generation:
+            # Compacted by another process: reread the whole index
+            self.generation = meta["generation"]
+            self._reset_index()
+            changed = True
+        self.dim = meta.get("dim")
+
+        if os.path.exists(self.names_path):
+            with open(self.names_path, "rb") as f:
+                f.seek(self._names_offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1  # ignore a partially written last line
+            if end:
+                new_names = data[:end - 1].decode().split("\n")
+                self.name_ids.update(zip(new_names, range(len(self.names), len(self.names) + len(new_names))))
+                self.names += new_names
+                self._names_offset += end
+                grow = len(self.names) - len(self.starts)
+                self.starts = np.concatenate([self.starts, np.zeros(grow, dtype=np.int64)])
+                self.counts = np.concatenate([self.counts, np.zeros(grow, dtype=np.int64)])
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                f.seek(self._index_offset)
+                records = np.frombuffer(f.read(), dtype=np.uint8)
+            records = records[:len(records) - len(records) % self.RECORD.itemsize].view(self.RECORD)
+            if len(records):
+                # Latest record per id wins
+                ids, last = np.unique(records["id"][::-1], return_index=True)
+                latest = records[len(records) - 1 - last]
+                self.starts[ids] = latest["start"]
+                self.counts[ids] = latest["count"]
+                self._index_offset += records.nbytes
+                changed = True
+        return changed
+
+    def add(self, name, vectors):
+        """
+        Appends a person's (already normalized) embeddings, replacing any
+        earlier ones for the same name.
+        """
+        with self._locked(exclusive=True):
+            self._refresh()
+            self._add(name, vectors)
+
+    def _add(self, name, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.expected_dim is not None and vectors.shape[1] != self.expected_dim:
+            raise ValueError(f"Embedding size {vectors.shape[1]} does not match model size {self.expected_dim}")
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._write_meta()
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Embedding size {vectors.shape[1]} does not match store size {self.dim}")
+
+        # Rows first, then the index record: a crash in between only leaves unreferenced rows
+        start = self.row_count()
+        with open(self.data_path, "ab") as f:
+            f.truncate(start * 4 * self.dim)  # drop a partial row left by an interrupted write
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self._append_record(self._name_id(name), start, len(vectors))
+        self._refresh()
+
+    def delete(self, name):
+        with self._locked(exclusive=True):
+            self._refresh()
+            name_id = self.name_ids.get(name)
+            if name_id is None or not self.counts[name_id]:
+                return False
+            self._append_record(name_id, 0, 0)
+            self._refresh()
+            return True
+
+    def live_ranges(self):
+        """
+        (ids, starts, counts) of every live person, in file order.
+        """
+        ids = np.flatnonzero(self.counts)
+        ids = ids[np.argsort(self.starts[ids], kind="stable")]
+        return ids, self.starts[ids], self.counts[ids]
+
+    def dead_rows(self):
+        return self.row_count() - int(self.counts.sum())
+
+    def snapshot(self):
+        """
+        (generation, names, starts, counts, matrix) read under the shared
+        lock, so the ranges always describe the mapped file. The mapping stays
+        valid after another worker compacts: os.replace keeps the old inode alive.
+        """
+        with self._locked():
+            self._refresh()
+            return self.generation, self.names, self.starts.copy(), self.counts.copy(), self.matrix()
+
+    def matrix(self):
+        """
+        Zero-copy read-only view of every row in the data file.
+        """
+        rows = self.row_count()
+        if not rows:
+            return None
+        return np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+
+    def compact(self):
+        """
+        Rewrites only live rows (grouped in file order) and bumps the
+        generation. Name ids are kept, so the names file is not rewritten.
+        """
+        with self._locked(exclusive=True):
+            self._refresh()
+            ids, old_starts, counts = self.live_ranges()
+            matrix = self.matrix()
+            with open(self.data_path + ".tmp", "wb") as f:
+                for old_start, count in zip(old_starts, counts):
+                    f.write(np.ascontiguousarray(matrix[old_start:old_start + count]).tobytes())
+            records = np.empty(len(ids), dtype=self.RECORD)
+            records["id"], records["count"] = ids, counts
+            records["start"] = np.cumsum(counts) - counts
+            records.tofile(self.index_path + ".tmp")
+            del matrix
+            os.replace(self.data_path + ".tmp", self.data_path)
+            os.replace(self.index_path + ".tmp", self.index_path)
+            self.generation += 1
+            self._write_meta()
+            self._reset_index()
+            self._refresh()
+
+    def upgrade_index(self):
+        """
+        One-time conversion of the JSONL index ({"name", "start", "count"}
+        per line) written by earlier versions into the binary index.
+        """
+        with self._locked(exclusive=True):
+            self._refresh()
+            if not os.path.exists(self.legacy_index_path) or os.path.exists(self.index_path):
+                return
+            latest = {}
+            with open(self.legacy_index_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    record = json.loads(line)
+                    latest[record["name"]] = (record["start"], record["count"])
+            live = [(name, start, count) for name, (start, count) in latest.items() if count]
+            self._append_names([name for name, _, _ in live if name not in self.name_ids])
+            self._append_records(np.array([(self.name_ids[n], c, s) for n, s, c in live], dtype=self.RECORD))
+            os.replace(self.legacy_index_path, self.legacy_index_path + ".old")
+            self._refresh()
+
+    def import_npy_files(self, directory):
+        """
+        One-time migration of legacy user_faces/{name}_faces.npy files
+        into an empty store. Files written by a different model (another
+        embedding width) are skipped; those users have to register again.
+        """
+        with self._locked(exclusive=True):
+            self._refresh()
+            if self.counts.any():
+                return
+            for path in sorted(glob.glob(os.path.join(directory, "*_faces.npy"))):
+                name = os.path.basename(path)[:-len("_faces.npy")]
+                vectors = FaceGallery.normalize(np.load(path))
+                dim = self.expected_dim or self.dim
+                if dim is not None and vectors.shape[1] != dim:
+                    print(f"Skipping {name}: embedding size {vectors.shape[1]} != {EMBEDDING_MODEL} size {dim}")
+                    continue
+                self._add(name, vectors)
+
+    def discard_incompatible(self, derived_paths=()):
+        """
+        Moves aside a store whose width does not match expected_dim (e.g. one
+        seeded from legacy 128-d files), so new registrations can be saved.
+        derived_paths (files built from the store, such as saved IVF
+        centroids) are moved aside with it.
+        """
+        with self._locked(exclusive=True):
+            self._refresh()
+            if self.expected_dim is None or self.dim in (None, self.expected_dim):
+                return
+            print(f"Embedding store has size {self.dim}, {EMBEDDING_MODEL} needs {self.expected_dim}: "
+                  f"moving it aside as *.dim{self.dim}")
+            for path in (self.data_path, self.names_path, self.index_path, *derived_paths):
+                if os.path.exists(path):
+                    os.replace(path, f"{path}.dim{self.dim}")
+            self.dim = None
+            self.generation += 1
+            self._write_meta()
+            self._reset_index()
+
+    def row_count(self):
+        """
+        Rows in the data file, live or dead.
+        """
+        if not self.dim or not os.path.exists(self.data_path):
+            return 0
+        return os.path.getsize(self.data_path) // (4 * self.dim)
+
+    def _name_id(self, name):
+        if name not in self.name_ids:
+            self._append_names([name])
+        return self.name_ids[name]
+
+    def _append_names(self, names):
+        if not names:
+            return
+        with open(self.names_path, "ab") as f:
+            f.truncate(self._names_offset)  # drop a partial line left by an interrupted write
+            f.write("".join(name + "\n" for name in names).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        self._refresh()
+
+    def _append_record(self, name_id, start, count):
+        self._append_records(np.array([(name_id, count, start)], dtype=self.RECORD))
+
+    def _append_records(self, records):
+        with open(self.index_path, "ab") as f:
+            size = f.seek(0, os.SEEK_END)
+            f.truncate(size - size % self.RECORD.itemsize)  # drop a partial record left by an interrupted write
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_meta(self):
+        with open(self.meta_path + ".tmp", "w") as f:
+            json.dump({"dim": self.dim, "generation": self.generation}, f)
+        os.replace(self.meta_path + ".tmp", self.meta_path)
+
+
+# =========================================================
+# FACE GALLERY INDEX
+# =========================================================
+class FaceGallery:
+    """
+    In-memory index of enrolled faces.
+
+    All embeddings are kept in one L2-normalized float32 matrix, grouped by
+    person, so a single matrix-vector product scores the whole gallery.
+    With an IVF index attached, only the probed buckets are scored.
+
+    The k-th live person is names[ids[k]] and owns matrix rows
+    bounds[2k]:bounds[2k+1]; owners maps each row to its person's names
+    index. Rows outside every range (dead rows of a store file awaiting
+    compaction) have owner -1 and are never reported.
+    """
+
+    EMPTY_STATE = ([], np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.int32),
+                   None, None, None)
+
+    def __init__(self, ivf=None):
+        self._lock = threading.Lock()
+        self.ivf = ivf
+        # (names, ids, bounds, owners, matrix, assignments, lists) swapped as one snapshot
+        self._state = self.EMPTY_STATE
+        # Set when loaded from an EmbeddingStore: IVF assignments per file row,
+        # and the (generation, rows, starts, counts, owners) of the last load
+        self._store = None
+        self._store_generation = None
+        self._store_assignments = None
+        self._store_layout = None
+
+    @staticmethod
+    def normalize(vectors):
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    @classmethod
+    def from_store(cls, store):
+        gallery = cls()
+        gallery.load_store(store)
+        return gallery
+
+    @staticmethod
+    def segment_bounds(starts, counts):
+        return np.column_stack([starts, np.asarray(starts) + np.asarray(counts)]).ravel().astype(np.intp)
+
+    @staticmethod
+    def range_rows(starts, counts):
+        """
+        Row numbers covered by the [start, start + count) ranges, concatenated.
+        """
+        return np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+
+    def _store_owners(self, generation, starts, counts, rows):
+        """
+        Owner of every file row. When the store has only been appended to
+        since the last load, the previous owners are extended with the new
+        rows and the replaced or deleted people's old rows are cleared.
+        """
+        layout = self._store_layout
+        if layout is not None and layout[0] == generation and layout[1] <= rows:
+            _, old_rows, old_starts, old_counts, old_owners = layout
+            n = len(old_starts)
+            changed = np.flatnonzero((starts[:n] != old_starts) | (counts[:n] != old_counts))
+            owners = np.concatenate([old_owners, np.full(rows - old_rows, -1, dtype=np.int32)])
+            gone = changed[old_counts[changed] > 0]
+            owners[self.range_rows(old_starts[gone], old_counts[gone])] = -1
+            fresh = np.concatenate([changed, np.arange(n, len(starts))])
+        else:
+            owners = np.full(rows, -1, dtype=np.int32)
+            fresh = np.arange(len(starts))
+        fresh = fresh[counts[fresh] > 0]
+        owners[self.range_rows(starts[fresh], counts[fresh])] = np.repeat(fresh, counts[fresh])
+        return owners
+
+    def load_store(self, store, ivf=None):
+        """
+        Rebuilds the index from an EmbeddingStore. The matrix is always the
+        memory-mapped file itself, dead rows included, so nothing is copied
+        and workers share the page cache; dead rows are masked by owner -1.
+        A new ivf replaces the attached one once every row is assigned to it.
+        """
+        with self._lock:
+            self._store = store
+            generation, names, starts, counts, file_matrix = store.snapshot()
+            # Assignments made with the attached index; a new ivf starts over
+            store_assignments = self._store_assignments
+            if ivf is None or ivf is self.ivf:
+                ivf = self.ivf
+            else:
+                store_assignments = None
+            if ivf is not None and file_matrix is not None and ivf.centroids.shape[1] != file_matrix.shape[1]:
+                print(f"Dropping IVF index: centroid size {ivf.centroids.shape[1]} != store size {file_matrix.shape[1]}")
+                ivf = store_assignments = None
+            if not counts.any() or file_matrix is None:
+                self.ivf, self._store_assignments, self._store_layout = ivf, None, None
+                self._state = self.EMPTY_STATE
+                return
+
+            ids = np.flatnonzero(counts)
+            ids = ids[np.argsort(starts[ids], kind="stable")]
+            owners = self._store_owners(generation, starts, counts, len(file_matrix))
+
+            assignments = lists = None
+            if ivf is not None:
+                # Only rows appended since the last load need a bucket
+                if self._store_generation != generation or store_assignments is None:
+                    store_assignments = np.zeros(0, dtype=np.int32)
+                done = len(store_assignments)
+                if done < len(file_matrix):
+                    new = ivf.assign(np.asarray(file_matrix[done:]))
+                    store_assignments = np.concatenate([store_assignments, new])
+                # Dead rows go to a bucket past the last one, which is never probed
+                assignments = np.where(owners >= 0, store_assignments[:len(file_matrix)],
+                                       len(ivf.centroids)).astype(np.int32)
+                lists = ivf.inverted_lists(assignments)
+
+            # Committed together, so a failed load leaves the previous index in place
+            self.ivf, self._store_assignments, self._store_generation = ivf, store_assignments, generation
+            self._store_layout = (generation, len(file_matrix), starts, counts, owners)
+            bounds = self.segment_bounds(starts[ids], counts[ids])
+            self._state = (names, ids, bounds, owners, file_matrix, assignments, lists)
+
+    @classmethod
+    def from_entries(cls, entries):
+        # Format: [{"name": "John", "embedding": [...]}, ...]
+        grouped = {}
+        for e in entries:
+            grouped.setdefault(e["name"], []).append(e["embedding"])
+        gallery = cls()
+        gallery.add_many(grouped.items())
+        return gallery
+
+    def add(self, name, embeddings):
+        """
+        Adds or replaces one person's embeddings.
+        """
+        self.add_many([(name, embeddings)])
+
+    def add_many(self, people):
+        """
+        Adds or replaces (name, embeddings) pairs in one rebuild
+        (copy-on-write, so concurrent searches always see a consistent snapshot).
+        """
+        batch = {}
+        for name, embeddings in people:
+            vectors = self.normalize(embeddings)
+            if len(vectors):
+                batch[name] = vectors
+        if not batch:
+            return
+
+        with self._lock:
+            names, _, _, owners, matrix, assignments, lists = self._state
+            dim = next(iter(batch.values())).shape[1] if matrix is None else matrix.shape[1]
+            for name in [n for n, v in batch.items() if v.shape[1] != dim]:
+                print(f"Skipping {name}: embedding size {batch.pop(name).shape[1]} != gallery size {dim}")
+            if not batch:
+                return
+
+            # Drop replaced people's old rows, then append the new ones at the end
+            keep = np.ones(len(owners), dtype=bool)
+            dropped = np.array([n in batch for n in names], dtype=bool)
+            if dropped.any():
+                keep = ~dropped[owners]
+                owners = (np.cumsum(~dropped) - 1)[owners[keep]].astype(np.int32)
+                names = [n for n in names if n not in batch]
+
+            vectors = np.vstack(list(batch.values()))
+            new_owners = np.repeat(np.arange(len(names), len(names) + len(batch)), [len(v) for v in batch.values()])
+            owners = np.concatenate([owners, new_owners]).astype(np.int32)
+            starts = np.flatnonzero(np.diff(np.concatenate([[-1], owners]))).astype(np.intp)
+            bounds = self.segment_bounds(starts, np.diff(np.append(starts, len(owners))))
+            names = names + list(batch)
+            matrix = vectors if matrix is None else np.vstack([matrix[keep], vectors])
+
+            if self.ivf is not None:
+                old_assignments = np.zeros(0, dtype=np.int32) if assignments is None else assignments[keep]
+                assignments = np.concatenate([old_assignments, self.ivf.assign(vectors)])
+                lists = self.ivf.inverted_lists(assignments)
+
+            self._state = (names, np.arange(len(names)), bounds, owners, matrix, assignments, lists)
+
+    def build_ivf(self, nlist, path=None, ivf=None):
+        """
+        Attaches ivf, or an IVF index trained on the current gallery, and
+        assigns every row. Training runs outside the lock, so searches and
+        reloads carry on (exactly) until the assignments are in place; self.ivf
+        is only set once they are, and is left unchanged on failure.
+        """
+        matrix = self._state[4]
+        if matrix is None:
+            return
+        if ivf is None:
+            ivf = IVFIndex.train(np.asarray(matrix), nlist)
+            if path:
+                ivf.save(path)
+        if ivf.centroids.shape[1] != matrix.shape[1]:
+            raise ValueError(f"IVF centroid size {ivf.centroids.shape[1]} does not match gallery size {matrix.shape[1]}")
+        if self._store is not None:
+            self.load_store(self._store, ivf)
+            return
+        with self._lock:
+            names, ids, bounds, owners, matrix, _, _ = self._state
+            assignments = ivf.assign(matrix)
+            self._state = (names, ids, bounds, owners, matrix, assignments, ivf.inverted_lists(assignments))
+            self.ivf = ivf
+
+    def search(self, embedding, top_k=1, nprobe=None):
+        """
+        Returns up to top_k (name, similarity) pairs, best first.
+        A person's score is the best match over all of their embeddings.
+        nprobe uses the IVF index (when built); None searches exactly.
+        """
+        names, ids, bounds, owners, matrix, assignments, lists = self._state
+        if matrix is None or not len(ids):
+            return []
+
+        query = self.normalize(embedding)[0]
+        if query.shape[0] != matrix.shape[1]:
+            raise ValueError(f"Embedding size {query.shape[0]} does not match gallery size {matrix.shape[1]}")
+        top_k = max(1, min(top_k, len(ids)))
+
+        if nprobe is None or assignments is None:
+            # Max over each person's row range; the odd segments (gaps between
+            # ranges) are discarded. The padding keeps the last bound in range.
+            scores = np.maximum.reduceat(np.append(matrix @ query, 0.0), bounds)[::2]
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            best = best[np.argsort(-scores[best])]
+            return [(names[ids[i]], float(scores[i])) for i in best]
+
+        list_rows, offsets = lists
+        rows = np.concatenate([list_rows[offsets[b]:offsets[b + 1]] for b in self.ivf.probe(query, nprobe)])
+        if len(rows) == 0:
+            return []
+        scores = matrix[rows] @ query
+        order = np.argsort(-scores)
+        # First occurrence of each person in score order is their best match
+        _, first = np.unique(owners[rows[order]], return_index=True)
+        picks = order[np.sort(first)[:top_k]]
+        return [(names[owners[rows[i]]], float(scores[i])) for i in picks]
+
+    def __len__(self):
+        return len(self._state[1])
+
+    @property
+    def dim(self):
+        matrix = self._state[4]
+        return None if matrix is None else matrix.shape[1]
+
+    @property
+    def size(self):
+        """
+        Number of live embeddings.
+        """
+        bounds = self._state[2]
+        return int((bounds[1::2] - bounds[::2]).sum())
+
+
+embedding_store = EmbeddingStore(SAVE_DIR, EMBEDDING_SIZE)
+embedding_store.upgrade_index()
+embedding_store.discard_incompatible([ANN_INDEX_PATH])
+embedding_store.import_npy_files(SAVE_DIR)
+if embedding_store.dead_rows() > COMPACT_DEAD_RATIO * max(1, embedding_store.row_count()):
+    embedding_store.compact()
+gallery = FaceGallery.from_store(embedding_store)
+
+
+def sync_gallery():
+    """
+    Picks up registrations and deletions made by other workers.
+    """
+    if embedding_store.refresh():
+        gallery.load_store(embedding_store)
+
+
+async def run_blocking(func, *args):
+    """
+    Runs blocking work (store fsync/compaction, index rebuilds, session
+    database transactions, image decoding) on the default thread pool
+    instead of the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, *args))
+
+
+ivf_build_lock = threading.Lock()
+ivf_build_started = False
+
+
+def build_gallery_ivf():
+    global ivf_build_started
+    try:
+        ivf = IVFIndex.load(ANN_INDEX_PATH) if os.path.exists(ANN_INDEX_PATH) else None
+        if ivf is not None and ivf.centroids.shape[1] != gallery.dim:
+            print(f"Retraining IVF index: saved centroid size {ivf.centroids.shape[1]} != gallery size {gallery.dim}")
+            ivf = None
+        gallery.build_ivf(ANN_NLIST, ANN_INDEX_PATH, ivf)
+    except Exception as e:
+        print(f"IVF index build failed, staying on exact search: {e}")
+    finally:
+        with ivf_build_lock:
+            ivf_build_started = False
+
+
+def ensure_ivf():
+    """
+    Starts loading/training the IVF index on a background thread once the
+    gallery reaches ANN_MIN_SIZE and has none attached (at most one build at
+    a time; a failed or dropped index is rebuilt on a later call).
+    """
+    global ivf_build_started
+    if not ANN_ENABLED or gallery.ivf is not None or gallery.size < ANN_MIN_SIZE:
+        return
+    with ivf_build_lock:
+        if ivf_build_started:
+            return
+        ivf_build_started = True
+    threading.Thread(target=build_gallery_ivf, name="ivf-build", daemon=True).start()
+
+
+def gallery_nprobe():
+    """
+    Returns the IVF nprobe to search with, or None for exact search.
+    Exact search is served while the IVF index is still being built.
+    """
+    sync_gallery()
+    if not ANN_ENABLED:
+        return None
+    ensure_ivf()
+    return ANN_NPROBE if gallery.ivf is not None else None
+
+
+# =========================================================
+# REGISTRATION SESSION STORE
+# =========================================================
+class RegistrationSessions:
+    """
+    Registration sessions in a local SQLite file, so concurrent clients and
+    multiple worker processes can enroll at the same time.
+    Sessions expire after ttl seconds; the oldest are evicted past max_sessions.
+    A session takes at most `steps` embeddings.
+    """
+
+    def __init__(self, path, ttl, max_sessions, steps):
+        self.path = path
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.steps = steps
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, name TEXT NOT NULL, step INTEGER NOT NULL, "
+                "embeddings BLOB NOT NULL, dim INTEGER NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at)")
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=10, isolation_level=None))
+
+    def start(self, name):
+        session_id = str(uuid.uuid4())
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM sessions WHERE id IN "
+                "(SELECT id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_sessions - 1,)
+            )
+            conn.execute(
+                "INSERT INTO sessions (id, name, step, embeddings, dim, updated_at) VALUES (?, ?, 0, ?, 0, ?)",
+                (session_id, name, b"", now)
+            )
+            conn.execute("COMMIT")
+        return session_id
+
+    def get(self, session_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT name, step, embeddings, dim, updated_at FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        return self._to_session(row)
+
+    def add_embedding(self, session_id, embedding):
+        """
+        Appends one embedding and advances the step atomically. A session that
+        already has all its steps is left unchanged and returned with
+        "added": False, so of several concurrent or retried uploads exactly
+        one completes it.
+        """
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT name, step, embeddings, dim, updated_at FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            if self._to_session(row) is None:
+                conn.execute("ROLLBACK")
+                return None
+            name, step, blob, dim, _ = row
+            if step >= self.steps:
+                conn.execute("ROLLBACK")
+                return dict(self._to_session(row), added=False)
+            blob, step, now = blob + vector.tobytes(), step + 1, time.time()
+            conn.execute(
+                "UPDATE sessions SET step = ?, embeddings = ?, dim = ?, updated_at = ? WHERE id = ?",
+                (step, blob, len(vector), now, session_id)
+            )
+            conn.execute("COMMIT")
+        return dict(self._to_session((name, step, blob, len(vector), now)), added=True)
+
+    def delete(self, session_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def _to_session(self, row):
+        if row is None or row[4] < time.time() - self.ttl:
+            return None
+        name, step, blob, dim, _ = row
+        embeddings = np.frombuffer(blob, dtype=np.float32).reshape(-1, dim) if dim else np.zeros((0, 0), np.float32)
+        return {"name": name, "step": step, "embeddings": embeddings}
+
+
+sessions = RegistrationSessions(SESSION_DB_PATH, SESSION_TTL, MAX_SESSIONS, len(directions))
+
+
+# =========================================================
+# HAAR-CASCADE FACE PRE-FILTER
+# =========================================================
+class NoFaceError(ValueError):
+    pass
+
+
+class FacePrefilter:
+    """
+    Cheap Haar-cascade check run before DeepFace. Rejects images without a
+    usable face and returns a crop around the face(s), so the embedding model
+    only sees a small region. Keeps rejection and timing counters.
+    """
+
+    def __init__(self, cascade_file, enabled=True):
+        self.path = os.path.join(os.path.dirname(os.path.abspath(__file__)), cascade_file)
+        if not os.path.exists(self.path):
+            self.path = os.path.join(cv2.data.haarcascades, cascade_file)
+        self.enabled = enabled and not cv2.CascadeClassifier(self.path).empty()
+        if enabled and not self.enabled:
+            print(f"Face pre-filter disabled: could not load {cascade_file}")
+        # CascadeClassifier is not safe to share between threads
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.rejected = 0
+        self.reasons = {}
+        self.prefilter_seconds = 0.0
+        self.crop_ratio_sum = 0.0
+        self.inferences = 0
+        self.inference_seconds = 0.0
+
+    def _cascade(self):
+        cascade = getattr(self._local, "cascade", None)
+        if cascade is None:
+            cascade = self._local.cascade = cv2.CascadeClassifier(self.path)
+        return cascade
+
+    def check(self, img, all_faces=False):
+        """
+        Returns (crop, (x0, y0)) with the crop offset in img coordinates, or
+        raises NoFaceError. The crop covers the largest face, or every face
+        when all_faces is set, plus PREFILTER_MARGIN on each side.
+        """
+        if not self.enabled:
+            return img, (0, 0)
+        start = time.perf_counter()
+        try:
+            x0, y0, x1, y1 = self._face_region(img, all_faces)
+        except NoFaceError as e:
+            self._record(time.perf_counter() - start, reason=str(e))
+            raise
+        crop = np.ascontiguousarray(img[y0:y1, x0:x1])
+        self._record(time.perf_counter() - start, crop_ratio=crop.size / img.size)
+        return crop, (x0, y0)
+
+    def _face_region(self, img, all_faces):
+        height, width = img.shape[:2]
+        cascade = self._cascade()
+        # Scan at the size where PREFILTER_MIN_FACE fills the cascade window (never upscaled)
+        window = min(cascade.getOriginalWindowSize())
+        factor = window / max(window, PREFILTER_MIN_FACE)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if factor < 1.0:
+            gray = cv2.resize(gray, (max(1, int(width * factor)), max(1, int(height * factor))),
+                              interpolation=cv2.INTER_AREA)
+        faces = cascade.detectMultiScale(gray, PREFILTER_SCALE_FACTOR, PREFILTER_MIN_NEIGHBORS)
+        if len(faces) == 0:
+            raise NoFaceError("no face found by pre-filter")
+
+        if PREFILTER_REJECT_OFF_FRAME:
+            inside = [
+                f for f in faces
+                if f[0] > PREFILTER_EDGE and f[1] > PREFILTER_EDGE
+                and f[0] + f[2] < gray.shape[1] - PREFILTER_EDGE and f[1] + f[3] < gray.shape[0] - PREFILTER_EDGE
+            ]
+            if not inside:
+                raise NoFaceError("face is cut off by the image border")
+            faces = inside
+        if not all_faces:
+            faces = [max(faces, key=lambda f: f[2] * f[3])]
+
+        boxes = np.array(faces, dtype=np.float32) / factor
+        margin = PREFILTER_MARGIN * boxes[:, 2:4]
+        x0 = int(max(0, (boxes[:, 0] - margin[:, 0]).min()))
+        y0 = int(max(0, (boxes[:, 1] - margin[:, 1]).min()))
+        x1 = int(min(width, (boxes[:, 0] + boxes[:, 2] + margin[:, 0]).max()))
+        y1 = int(min(height, (boxes[:, 1] + boxes[:, 3] + margin[:, 1]).max()))
+        return x0, y0, x1, y1
+
+    def _record(self, seconds, reason=None, crop_ratio=0.0):
+        with self._lock:
+            self.checked += 1
+            self.prefilter_seconds += seconds
+            self.crop_ratio_sum += crop_ratio
+            if reason is not None:
+                self.rejected += 1
+                self.reasons[reason] = self.reasons.get(reason, 0) + 1
+
+    def record_inference(self, seconds, images=1):
+        with self._lock:
+            self.inferences += images
+            self.inference_seconds += seconds
+
+    def stats(self):
+        """
+        Time saved is estimated as rejected uploads x mean DeepFace time per
+        accepted image, minus the cost of running the pre-filter on everything.
+        """
+        with self._lock:
+            accepted = self.checked - self.rejected
+            mean_inference = self.inference_seconds / self.inferences if self.inferences else 0.0
+            return {
+                "enabled": self.enabled,
+                "checked": self.checked,
+                "rejected": self.rejected,
+                "rejection_rate": round(self.rejected / self.checked, 4) if self.checked else 0.0,
+                "reasons": dict(self.reasons),
+                "mean_prefilter_ms": round(1000 * self.prefilter_seconds / self.checked, 3) if self.checked else 0.0,
+                "mean_inference_ms": round(1000 * mean_inference, 3),
+                "mean_crop_area": round(self.crop_ratio_sum / accepted, 4) if accepted else 0.0,
+                "estimated_time_saved_ms": round(1000 * (self.rejected * mean_inference - self.prefilter_seconds), 1),
+            }
+
+
+face_prefilter = FacePrefilter(PREFILTER_CASCADE, PREFILTER_ENABLED)
+
+
+async def prefilter(img, all_faces=False):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(face_prefilter.check, img, all_faces))
+
+
+# =========================================================
+# MODEL WARM-UP AND INFERENCE EXECUTOR
+# =========================================================
+def warm_up_model(model_name):
+    """
+    Builds the model and runs one dummy inference so the first real
+    request does not pay for graph construction.
+    """
+    start = time.perf_counter()
+    DeepFace.represent(
+        np.zeros((160, 160, 3), dtype=np.uint8),
+        model_name=model_name,
+        enforce_detection=False
+    )
+    return time.perf_counter() - start
+
+
+async def warm_up_models():
+    loop = asyncio.get_running_loop()
+    try:
+        for model_name in PRELOAD_MODELS:
+            seconds = await loop.run_in_executor(inference_executor, warm_up_model, model_name)
+            model_status["models"][model_name] = round(seconds, 3)
+        model_status["ready"] = True
+    except Exception as e:
+        model_status["error"] = str(e)
+
+
+@app.on_event("startup")
+async def preload_models():
+    # Warm-up is queued first on the inference executor, so early requests wait behind it
+    asyncio.create_task(warm_up_models())
+    ensure_ivf()
+
+
+async def represent(img, **kwargs):
+    """
+    Runs DeepFace.represent on the inference executor instead of the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(inference_executor, partial(timed_represent, img, **kwargs))
+
+
+def timed_represent(img, **kwargs):
+    start = time.perf_counter()
+    result = DeepFace.represent(img, model_name=EMBEDDING_MODEL, **kwargs)
+    face_prefilter.record_inference(time.perf_counter() - start)
+    return result
+
+
+# =========================================================
+# BATCHED DETECTION + EMBEDDING
+# =========================================================
+def fit_to_input(face, target_size):
+    """
+    Scales a face crop to fit target_size (height, width) and zero-pads the
+    rest, the same way DeepFace.represent prepares its input.
+    """
+    height, width = target_size
+    factor = min(height / face.shape[0], width / face.shape[1])
+    resized = cv2.resize(face, (max(1, int(face.shape[1] * factor)), max(1, int(face.shape[0] * factor))))
+    top = (height - resized.shape[0]) // 2
+    left = (width - resized.shape[1]) // 2
+    padded = np.zeros((height, width, face.shape[2]), dtype=np.float32)
+    padded[top:top + resized.shape[0], left:left + resized.shape[1]] = resized
+    return padded
+
+
+def forward_batch(faces):
+    """
+    One forward pass of the embedding network over all face crops.
+    """
+    model = DeepFace.build_model(EMBEDDING_MODEL)
+    network = getattr(model, "model", model)
+    target_size = network.input_shape[1:3]
+    # extract_faces returns RGB crops in [0, 1]; represent feeds the network BGR
+    batch = np.stack([fit_to_input(face[:, :, ::-1], target_size) for face in faces])
+    return np.asarray(network.predict(batch, verbose=0))
+
+
+def embed_images(images, all_faces=False, scales=None):
+    """
+    Detects faces in every image, then embeds all crops in one batch.
+    Returns, per image, a list of {"facial_area", "embedding"} dicts, or an
+    error string when no face was detected. Facial areas are mapped back to
+    the uploaded resolution using scales from decode_image. Images rejected
+    by the pre-filter never reach DeepFace.
+    """
+    start = time.perf_counter()
+    crops, owners, results = [], [], []
+    for i, img in enumerate(images):
+        try:
+            img, offset = face_prefilter.check(img, all_faces)
+            faces = DeepFace.extract_faces(img, detector_backend=DETECTOR_BACKEND, enforce_detection=True, align=True)
+        except ValueError as e:
+            results.append(str(e))
+            continue
+        if not all_faces:
+            faces = [max(faces, key=lambda f: f["facial_area"]["w"] * f["facial_area"]["h"])]
+        scale = scales[i] if scales else 1.0
+        results.append([{"facial_area": to_original_coords(f["facial_area"], scale, offset)} for f in faces])
+        crops += [f["face"] for f in faces]
+        owners += [(i, j) for j in range(len(faces))]
+
+    if crops:
+        try:
+            embeddings = forward_batch(crops)
+        except (AttributeError, TypeError):
+            # DeepFace build without a Keras-style network: embed crops one by one
+            embeddings = [
+                DeepFace.represent(face[:, :, ::-1] * 255, model_name=EMBEDDING_MODEL, detector_backend="skip")[0]["embedding"]
+                for face in crops
+            ]
+        for (i, j), embedding in zip(owners, embeddings):
+            results[i][j]["embedding"] = np.asarray(embedding, dtype=np.float32)
+    embedded = sum(1 for r in results if not isinstance(r, str))
+    if embedded:
+        face_prefilter.record_inference(time.perf_counter() - start, embedded)
+    return results
+
+
+async def embed_images_async(images, all_faces=False, scales=None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(inference_executor, partial(embed_images, images, all_faces, scales))
+
+
+# =========================================================
+# IMAGE DECODING (ONCE, STRAIGHT TO BGR, CAPPED SIZE)
+# =========================================================
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def decode_image(image_bytes, max_side=MAX_DETECT_SIDE):
+    """
+    Decodes an upload once, directly into the BGR order DeepFace expects.
+    Large JPEGs are decoded at a reduced DCT scale that still covers
+    max_side, and the result is capped to max_side on its longest side.
+    Returns (image, scale), where scale maps original pixels to decoded ones.
+    """
+    try:
+        original_side = max(Image.open(io.BytesIO(image_bytes)).size)  # header only
+    except Exception:
+        original_side = None
+
+    flag = cv2.IMREAD_COLOR
+    if original_side and max_side:
+        for factor, reduced_flag in REDUCED_DECODE_FLAGS:
+            if original_side / factor >= max_side:
+                flag = reduced_flag
+                break
+
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+    if img is None:
+        raise ValueError("Image could not be decoded")
+
+    side = max(img.shape[:2])
+    if max_side and side > max_side:
+        factor = max_side / side
+        img = cv2.resize(
+            img,
+            (max(1, round(img.shape[1] * factor)), max(1, round(img.shape[0] * factor))),
+            interpolation=cv2.INTER_AREA
+        )
+    scale = max(img.shape[:2]) / original_side if original_side else 1.0
+    return img, scale
+
+
+async def decode_uploads(images):
+    """
+    Reads every upload, then decodes them in parallel on the default thread
+    pool. Returns (image, scale) pairs in upload order.
+    """
+    payloads = [await image.read() for image in images]
+    return await asyncio.gather(*(run_blocking(decode_image, data) for data in payloads))
+
+
+def to_original_coords(area, scale, offset=(0, 0)):
+    """
+    Maps a DeepFace facial_area (x, y, w, h and optional eye points) from the
+    decoded image, or a pre-filter crop of it at offset, back to the uploaded image.
+    """
+    if scale == 1.0 and offset == (0, 0):
+        return area
+    dx, dy = offset
+    mapped = {}
+    for key, value in area.items():
+        if isinstance(value, (int, float)):
+            shift = dx if key == "x" else dy if key == "y" else 0
+            mapped[key] = int(round((value + shift) / scale))
+        elif isinstance(value, (tuple, list)):
+            mapped[key] = [int(round((v + (dy if k % 2 else dx)) / scale)) for k, v in enumerate(value)]
+        else:
+            mapped[key] = value
+    return mapped
+
+
+@app.get("/face/prefilter/stats")
+async def prefilter_stats():
+    """
+    Pre-filter rejection rate, rejection reasons and estimated inference time saved.
+    """
+    return face_prefilter.stats()
+
+
+@app.get("/health/ready")
+async def readiness():
+    """
+    Reports whether the embedding models are loaded and warmed up.
+    """
+    return JSONResponse(model_status, status_code=200 if model_status["ready"] else 503)
 
 
 # =========================================================
@@ -32,18 +1246,19 @@ current_step = 0
 @app.post("/face/register/start")
 async def start_registration(name: str = Form(...)):
     """
-    Starts the face registration process for a user.
+    Starts the face registration process for a user and returns its session id.
     """
-    global current_name, current_embeddings, current_step
-
-    current_name = name.strip()
-    current_embeddings = []
-    current_step = 0
+    try:
+        name = clean_name(name)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
+    session_id = await run_blocking(sessions.start, name)
 
     return {
         "status": "ok",
-        "message": f"Registration started for {current_name}",
-        "next_step": directions[current_step]
+        "session_id": session_id,
+        "message": f"Registration started for {name}",
+        "next_step": directions[0]
     }
 
 
@@ -51,41 +1266,45 @@ async def start_registration(name: str = Form(...)):
 # 2) REGISTER EACH STEP (IMAGE UPLOAD)
 # =========================================================
 @app.post("/face/register/step")
-async def register_step(image: UploadFile = File(...)):
+async def register_step(session_id: str = Form(...), image: UploadFile = File(...)):
     """
-    Receives an image for the current direction and extracts embeddings.
+    Receives an image for the session's current direction and extracts embeddings.
     """
-    global current_step, current_embeddings
+    session = await run_blocking(sessions.get, session_id)
+    if session is None:
+        return session_not_found()
+    if session["step"] >= len(directions):
+        return {"status": "done", "message": "All steps completed successfully"}
 
     image_bytes = await image.read()
-    img = np.array(Image.open(io.BytesIO(image_bytes)).convert("RGB"))
 
     try:
-        embedding_result = DeepFace.represent(
-            img,
-            model_name="Facenet",
-            enforce_detection=True
-        )
-
-        current_embeddings.append(embedding_result[0]["embedding"])
-        message = f"{directions[current_step]} step completed"
-        current_step += 1
-
+        img, _ = await run_blocking(decode_image, image_bytes)
+        img, _ = await prefilter(img)
+        embedding_result = await represent(img, enforce_detection=True)
     except Exception as e:
         return JSONResponse(
             {"status": "error", "message": f"Face could not be detected: {str(e)}"},
             status_code=400
         )
 
-    if current_step >= len(directions):
-        file_path = os.path.join(SAVE_DIR, f"{current_name}_faces.npy")
-        np.save(file_path, current_embeddings)
+    session = await run_blocking(sessions.add_embedding, session_id, embedding_result[0]["embedding"])
+    if session is None:
+        return session_not_found()
+    if not session["added"]:
+        # Another upload for this session completed the last step first
+        return {"status": "done", "message": "All steps completed successfully"}
+    message = f"{directions[session['step'] - 1]} step completed"
+
+    # Only the upload that took the last step saves the registration
+    if session["step"] == len(directions):
+        await run_blocking(save_registration, session["name"], session["embeddings"])
         return {"status": "done", "message": "All steps completed successfully"}
 
     return {
         "status": "ok",
         "message": message,
-        "next_step": directions[current_step]
+        "next_step": directions[session["step"]]
     }
 
 
@@ -93,29 +1312,108 @@ async def register_step(image: UploadFile = File(...)):
 # 3) FINISH REGISTRATION
 # =========================================================
 @app.post("/face/register/finish")
-async def finish_registration():
+async def finish_registration(session_id: str = Form(...)):
     """
-    Saves all collected embeddings to disk.
+    Saves the session's collected embeddings to disk (if the last step has
+    not already done so) and closes the session.
     """
-    global current_name, current_embeddings
+    session = await run_blocking(sessions.get, session_id)
+    if session is None:
+        return session_not_found()
 
-    file_path = os.path.join(SAVE_DIR, f"{current_name}_faces.npy")
-    np.save(file_path, current_embeddings)
+    if session["step"] < len(directions):
+        await run_blocking(save_registration, session["name"], session["embeddings"])
+    await run_blocking(sessions.delete, session_id)
 
     return {
         "status": "ok",
-        "message": f"Registration completed for {current_name}"
+        "message": f"Registration completed for {session['name']}"
+    }
+
+
+# =========================================================
+# 3b) BATCH REGISTRATION (ALL POSES IN ONE REQUEST)
+# =========================================================
+@app.post("/face/register/batch")
+async def register_batch(name: str = Form(...), images: List[UploadFile] = File(...)):
+    """
+    Registers a user from all pose images at once (one per direction, in
+    the order of directions), running detection and a single batched
+    embedding pass.
+    """
+    if len(images) != len(directions):
+        return JSONResponse(
+            {"status": "error", "message": f"Expected {len(directions)} images, one per direction: {directions}"},
+            status_code=400
+        )
+    try:
+        name = clean_name(name)
+        frames = [frame for frame, _ in await decode_uploads(images)]
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
+
+    results = await embed_images_async(frames)
+    failed = [i for i, r in enumerate(results) if isinstance(r, str)]
+    if failed:
+        return JSONResponse(
+            {"status": "error", "message": f"Face could not be detected in images {failed}"},
+            status_code=400
+        )
+
+    embeddings = np.stack([r[0]["embedding"] for r in results])
+    await run_blocking(save_registration, name, embeddings)
+
+    return {
+        "status": "done",
+        "message": f"Registration completed for {name}",
+        "images": len(frames)
     }
 
 
+def save_registration(name, embeddings):
+    if len(embeddings) == 0:
+        return
+    embedding_store.add(name, FaceGallery.normalize(embeddings))
+    if embedding_store.dead_rows() > COMPACT_DEAD_RATIO * embedding_store.row_count():
+        embedding_store.compact()
+    gallery.load_store(embedding_store)
+
+
 # =========================================================
-# COSINE SIMILARITY FUNCTION
+# DELETE A REGISTERED USER
 # =========================================================
-def cosine_similarity(a, b):
-    dot = np.dot(a, b)
-    norm_a = np.linalg.norm(a)
-    norm_b = np.linalg.norm(b)
-    return dot / (norm_a * norm_b)
+@app.delete("/face/users/{name}")
+async def delete_user(name: str):
+    """
+    Removes a user from the gallery (tombstone; space is reclaimed by compaction).
+    """
+    if not await run_blocking(delete_registration, name):
+        return JSONResponse({"status": "error", "message": f"Unknown user {name}"}, status_code=404)
+    return {"status": "ok", "message": f"Deleted {name}"}
+
+
+def delete_registration(name):
+    if not embedding_store.delete(name):
+        return False
+    gallery.load_store(embedding_store)
+    return True
+
+
+def clean_name(name):
+    """
+    Collapses whitespace and rejects empty, overlong or control-character names.
+    """
+    name = " ".join(name.split())
+    if not name or len(name) > MAX_NAME_LENGTH or any(not c.isprintable() for c in name):
+        raise ValueError("Invalid name")
+    return name
+
+
+def session_not_found():
+    return JSONResponse(
+        {"status": "error", "message": "Unknown or expired registration session"},
+        status_code=404
+    )
 
 
 # =========================================================
@@ -123,58 +1421,51 @@ def cosine_similarity(a, b):
 # =========================================================
 @app.post("/face/recognize")
 async def recognize_face(
-    embeddings_json: str = Form(...),   # Sent from Flutter
-    image: UploadFile = File(...)
+    image: UploadFile = File(...),
+    embeddings_json: str = Form(None),   # Optional, legacy Flutter gallery
+    top_k: int = Form(1)
 ):
     """
-    Recognizes a face by comparing it with embeddings sent from client.
+    Recognizes a face against the server-side gallery index, or against
+    embeddings sent from the client when embeddings_json is given.
     """
     try:
         # -------------------------------
         # Read Image
         # -------------------------------
-        img_bytes = await image.read()
-        np_img = np.frombuffer(img_bytes, np.uint8)
-        frame = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        frame, _ = await run_blocking(decode_image, await image.read())
 
         # -------------------------------
-        # Parse embeddings from Flutter
+        # Pick gallery: server index, or embeddings from Flutter
         # Format: [{"name": "John", "embedding": [...]}, ...]
         # -------------------------------
-        embeddings_list = json.loads(embeddings_json)
-        names_list = [e["name"] for e in embeddings_list]
-        vectors_list = [np.array(e["embedding"]) for e in embeddings_list]
+        search_gallery, nprobe = gallery, await run_blocking(gallery_nprobe)
+        if embeddings_json:
+            search_gallery, nprobe = FaceGallery.from_entries(json.loads(embeddings_json)), None
 
         # -------------------------------
         # Extract embedding from image
         # -------------------------------
-        result = DeepFace.represent(
-            rgb_frame,
-            model_name="Facenet512"
-        )
+        frame, _ = await prefilter(frame)
+        result = await represent(frame)
         input_embedding = result[0]["embedding"]
 
         # -------------------------------
-        # Compare embeddings
+        # Score all identities at once
         # -------------------------------
-        best_score = 0.0
-        best_name = None
-
-        for i, vec in enumerate(vectors_list):
-            similarity = cosine_similarity(input_embedding, vec)
-            if similarity > best_score:
-                best_score = similarity
-                best_name = names_list[i]
+        matches = search_gallery.search(input_embedding, top_k=top_k, nprobe=nprobe)
+        best_name, best_score = matches[0] if matches else (None, 0.0)
+        top_matches = [{"name": n, "similarity": score} for n, score in matches]
 
         # -------------------------------
         # Return Result
         # -------------------------------
-        if best_score >= 0.65:
+        if best_score >= RECOGNITION_THRESHOLD:
             return JSONResponse({
                 "status": "ok",
                 "recognized_name": best_name,
                 "similarity": best_score,
+                "matches": top_matches,
                 "message": f"Recognized: {best_name} ({best_score*100:.1f}%)"
             })
         else:
@@ -182,8 +1473,47 @@ async def recognize_face(
                 "status": "ok",
                 "recognized_name": None,
                 "similarity": best_score,
+                "matches": top_matches,
                 "message": f"Not recognized ({best_score*100:.1f}%)"
             })
 
     except Exception as e:
         return JSONResponse({"status": "error", "message": str(e)})
+
+
+# =========================================================
+# 5) BATCH FACE RECOGNITION (MULTIPLE FRAMES / FACES)
+# =========================================================
+@app.post("/face/recognize/batch")
+async def recognize_batch(images: List[UploadFile] = File(...), top_k: int = Form(1)):
+    """
+    Recognizes every detected face in every uploaded frame, embedding all
+    faces in one batched pass.
+    """
+    try:
+        decoded = await decode_uploads(images)
+        frames, scales = [d[0] for d in decoded], [d[1] for d in decoded]
+        results = await embed_images_async(frames, all_faces=True, scales=scales)
+        nprobe = await run_blocking(gallery_nprobe)
+
+        response = []
+        for result in results:
+            if isinstance(result, str):
+                response.append({"faces": [], "message": result})
+                continue
+            faces = []
+            for face in result:
+                matches = gallery.search(face["embedding"], top_k=top_k, nprobe=nprobe)
+                best_name, best_score = matches[0] if matches else (None, 0.0)
+                faces.append({
+                    "facial_area": face["facial_area"],
+                    "recognized_name": best_name if best_score >= RECOGNITION_THRESHOLD else None,
+                    "similarity": best_score,
+                    "matches": [{"name": n, "similarity": score} for n, score in matches]
+                })
+            response.append({"faces": faces})
+
+        return JSONResponse({"status": "ok", "results": response})
+
+    except Exception as e:
+        return JSONResponse({"status": "error", "message": str(e)})
@@ -1,27 +1,371 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from datetime import datetime
-import uuid, os, joblib, random, numpy as np, pandas as pd
+import uuid, os, copy, joblib, random, threading, queue, time, numpy as np
+from itertools import islice
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from sklearn.ensemble import RandomForestClassifier
-import firebase_admin
-from firebase_admin import credentials, firestore
+import json, sqlite3
 
 # Model paths
 MODEL_MOTOR = "model_motor.joblib"
 MODEL_AC = "model_ac.joblib"
 MODEL_FACE = "model_face.joblib"
 
-# Firebase initialization
-if not firebase_admin._apps:
-    cred = credentials.Certificate("goruntuIsleme.json")
-    firebase_admin.initialize_app(cred)
-db = firestore.client()
+# Event store backend: "firestore" or "sqlite"
+EVENT_STORE = os.environ.get("EVENT_STORE", "firestore")
+FIREBASE_CREDENTIALS = os.environ.get("FIREBASE_CREDENTIALS", "goruntuIsleme.json")
+EVENT_DB_PATH = os.environ.get("EVENT_DB_PATH", "events.db")
+HISTORY_CACHE_TTL = float(os.environ.get("HISTORY_CACHE_TTL", "2"))
+MAX_HISTORY_LIMIT = int(os.environ.get("MAX_HISTORY_LIMIT", "1000"))
+
+# Synthetic data generation
+GENERATE_CHUNK_SIZE = int(os.environ.get("GENERATE_CHUNK_SIZE", "500"))
+GENERATE_WORKERS = int(os.environ.get("GENERATE_WORKERS", "4"))
+
+# Training: full retrain by default, or incremental from the last watermark
+TRAINING_DATA_DIR = os.environ.get("TRAINING_DATA_DIR", "training_data")
+TRAINING_CHUNK_SIZE = int(os.environ.get("TRAINING_CHUNK_SIZE", "5000"))
+INCREMENTAL_TREES = int(os.environ.get("INCREMENTAL_TREES", "20"))
+MAX_TREES = int(os.environ.get("MAX_TREES", "300"))
+TRAINING_N_JOBS = int(os.environ.get("TRAINING_N_JOBS", "-1"))
+MAX_TRAINING_JOBS = 50
+
+# Alert request coalescing (single-item /alert/motor and /alert/ac calls)
+COALESCE_ALERTS = os.environ.get("COALESCE_ALERTS", "0") == "1"
+COALESCE_WAIT_MS = float(os.environ.get("COALESCE_WAIT_MS", "5"))
+COALESCE_MAX_BATCH = int(os.environ.get("COALESCE_MAX_BATCH", "64"))
+
+
+# Metrics: per-route request counts/latency and per-stage timings, rendered
+# in the Prometheus text format at /metrics.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram:
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, labels, seconds):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            label_str = ",".join(f'{k}="{v}"' for k, v in zip(self.label_names, labels))
+            sep = "," if label_str else ""
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{{{label_str}{sep}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label_str}{sep}le="+Inf"}} {values[-2]}')
+            lines.append(f"{self.name}_count{{{label_str}}} {values[-2]}")
+            lines.append(f"{self.name}_sum{{{label_str}}} {values[-1]}")
+        return lines
+
+
+request_counts = Counter()
+request_counts_lock = threading.Lock()
+request_latency = LatencyHistogram("http_request_duration_seconds", "HTTP request latency by route.", ("method", "route"))
+stage_latency = LatencyHistogram(
+    "stage_duration_seconds",
+    "Time spent in model_load, feature_build, predict_proba and storage stages.",
+    ("stage",)
+)
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_latency.observe((stage,), time.perf_counter() - start)
+
+
+# Model registry: keeps each trained model in memory and reloads it only when
+# the file on disk changes. The file mtime (ns) doubles as the model version.
+class ModelRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def get(self, path):
+        try:
+            version = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None, None
+        entry = self._models.get(path)
+        if entry is None or entry[0] != version:
+            with self._lock:
+                entry = self._models.get(path)
+                if entry is None or entry[0] != version:
+                    with timed("model_load"):
+                        entry = (version, joblib.load(path))
+                    self._models[path] = entry
+        return entry[1], entry[0]
+
+    def publish(self, path, model):
+        # Write to a temp file and rename so readers never load a half-written model
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        joblib.dump(model, tmp_path)
+        os.replace(tmp_path, path)
+        version = os.stat(path).st_mtime_ns
+        with self._lock:
+            self._models[path] = (version, model)
+        return version
+
+    def loaded_versions(self):
+        with self._lock:
+            return {path: entry[0] for path, entry in self._models.items()}
+
+    def versions(self):
+        return {path: self.get(path)[1] for path in (MODEL_MOTOR, MODEL_AC, MODEL_FACE)}
+
+
+models = ModelRegistry()
+
+# Event stores: every endpoint goes through this interface instead of a
+# module-level Firestore client, so the API can also run on a local database.
+class EventStore:
+    max_batch_size = 500
+
+    def write_events(self, events):
+        raise NotImplementedError
+
+    def stream_events(self, since=None):
+        # Yields event dicts, only those with timestamp > since when given
+        raise NotImplementedError
+
+    def update_event(self, event_id, fields):
+        raise NotImplementedError
+
+    def history(self, device_id=None, limit=50, start_after=None, since=None, until=None):
+        # Newest first. start_after is the id of the last event of the previous
+        # page (KeyError if unknown); since is inclusive, until exclusive.
+        raise NotImplementedError
+
+
+class FirestoreEventStore(EventStore):
+    max_batch_size = 500
+
+    def __init__(self, credentials_path=FIREBASE_CREDENTIALS):
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+
+        if not firebase_admin._apps:
+            cred = credentials.Certificate(credentials_path)
+            firebase_admin.initialize_app(cred)
+        self._firestore = firestore
+        self.db = firestore.client()
+
+    def write_events(self, events):
+        batch = self.db.batch()
+        for ev in events:
+            ref = self.db.collection("events").document(ev["id"])
+            batch.set(ref, ev)
+        batch.commit()
+        return len(events)
+
+    def stream_events(self, since=None):
+        query = self.db.collection("events")
+        if since:
+            query = query.where("timestamp", ">", since)
+        for doc in query.stream():
+            yield doc.to_dict()
+
+    def update_event(self, event_id, fields):
+        from google.api_core.exceptions import NotFound
+
+        try:
+            self.db.collection("events").document(event_id).update(fields)
+        except NotFound:
+            raise KeyError(event_id)
+
+    def history(self, device_id=None, limit=50, start_after=None, since=None, until=None):
+        # Filters are applied before ordering; device_id + timestamp needs a composite index
+        query = self.db.collection("events")
+        if device_id:
+            query = query.where("device_id", "==", device_id)
+        if since:
+            query = query.where("timestamp", ">=", since)
+        if until:
+            query = query.where("timestamp", "<", until)
+        descending = self._firestore.Query.DESCENDING
+        query = query.order_by("timestamp", direction=descending).order_by("__name__", direction=descending)
+        if start_after:
+            cursor = self.db.collection("events").document(start_after).get()
+            if not cursor.exists:
+                raise KeyError(start_after)
+            query = query.start_after(cursor)
+        return [doc.to_dict() for doc in query.limit(limit).stream()]
+
+
+class SQLiteEventStore(EventStore):
+    max_batch_size = 5000
+
+    def __init__(self, path=EVENT_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "id TEXT PRIMARY KEY, device_id TEXT, timestamp TEXT, data TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_events_device_ts ON events (device_id, timestamp)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_events_ts ON events (timestamp)")
+        self._conn.commit()
+
+    def write_events(self, events):
+        rows = [(ev["id"], ev.get("device_id"), ev.get("timestamp"), json.dumps(ev)) for ev in events]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO events (id, device_id, timestamp, data) VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+        return len(rows)
+
+    def stream_events(self, since=None):
+        # Separate read connection so a long scan does not hold the write lock
+        conn = sqlite3.connect(self.path)
+        try:
+            if since:
+                cursor = conn.execute("SELECT data FROM events WHERE timestamp > ?", (since,))
+            else:
+                cursor = conn.execute("SELECT data FROM events")
+            for (data,) in cursor:
+                yield json.loads(data)
+        finally:
+            conn.close()
+
+    def update_event(self, event_id, fields):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM events WHERE id = ?", (event_id,)).fetchone()
+            if row is None:
+                raise KeyError(event_id)
+            ev = json.loads(row[0])
+            ev.update(fields)
+            self._conn.execute("UPDATE events SET data = ? WHERE id = ?", (json.dumps(ev), event_id))
+            self._conn.commit()
+
+    def history(self, device_id=None, limit=50, start_after=None, since=None, until=None):
+        clauses, params = [], []
+        if device_id:
+            clauses.append("device_id = ?")
+            params.append(device_id)
+        if since:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until:
+            clauses.append("timestamp < ?")
+            params.append(until)
+
+        with self._lock:
+            if start_after:
+                cursor = self._conn.execute("SELECT timestamp FROM events WHERE id = ?", (start_after,)).fetchone()
+                if cursor is None:
+                    raise KeyError(start_after)
+                clauses.append("(timestamp, id) < (?, ?)")
+                params += [cursor[0], start_after]
+
+            sql = "SELECT data FROM events"
+            if clauses:
+                sql += " WHERE " + " AND ".join(clauses)
+            sql += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+            rows = self._conn.execute(sql, params + [limit]).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+
+def create_event_store(backend=EVENT_STORE):
+    if backend == "firestore":
+        return FirestoreEventStore()
+    if backend == "sqlite":
+        return SQLiteEventStore()
+    raise ValueError(f"Unknown EVENT_STORE backend: {backend}")
+
+
+store = create_event_store()
+
+
+# History cache: short-TTL results per device, dropped when that device (or,
+# for unfiltered queries, any device) gets new writes in this process.
+class HistoryCache:
+    def __init__(self, ttl=HISTORY_CACHE_TTL, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def put(self, key, result):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+
+    def invalidate(self, device_ids=None):
+        # key[0] is the device_id filter; None means "all devices" and is always dropped
+        with self._lock:
+            if device_ids is None:
+                self._entries.clear()
+            else:
+                self._entries = {k: v for k, v in self._entries.items() if k[0] is not None and k[0] not in device_ids}
+
+
+history_cache = HistoryCache()
+
+
+def write_events(events):
+    with timed("storage"):
+        count = store.write_events(events)
+    history_cache.invalidate({ev.get("device_id") for ev in events})
+    return count
 
 # FastAPI app
 app = FastAPI(title="Smart Home Device Event Prediction API", version="1.2.0")
 
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        request_latency.observe((request.method, path), time.perf_counter() - start)
+        with request_counts_lock:
+            request_counts[(request.method, path, status)] += 1
+
+
 class Event(BaseModel):
     device_id: str
     timestamp: Optional[str] = None
@@ -40,9 +384,58 @@ class Feedback(BaseModel):
     accepted: bool
 
 
+# Feature extraction shared by training and serving. Timestamps are parsed
+# without pandas; batches take a vectorized path over the raw bytes.
+MOTOR_FEATURES = ("hour", "temperature", "humidity", "soilMoisture")
+AC_FEATURES = ("hour", "temperature", "humidity")
+FACE_FEATURES = ("hour",)
+
+
+def parse_timestamp(ts):
+    return datetime.fromisoformat(ts) if ts else datetime.utcnow()
+
+
+def parse_hour(ts):
+    # Fast path for "YYYY-MM-DDTHH..." / "YYYY-MM-DD HH..." strings
+    if ts and len(ts) >= 13 and ts[10] in "T " and ts[11:13].isdigit():
+        return int(ts[11:13])
+    return parse_timestamp(ts).hour
+
+
+def parse_hours(timestamps):
+    if not timestamps:
+        return np.zeros(0, dtype=np.int8)
+    try:
+        raw = np.array(timestamps, dtype="S13")
+    except (UnicodeEncodeError, TypeError):
+        return np.fromiter((parse_hour(ts) for ts in timestamps), dtype=np.int8, count=len(timestamps))
+
+    chars = raw.view(np.uint8).reshape(len(raw), 13)
+    digits = chars[:, 11:13].astype(np.int16) - ord("0")
+    ok = ((chars[:, 10] == ord("T")) | (chars[:, 10] == ord(" "))) & ((digits >= 0) & (digits <= 9)).all(axis=1)
+    hours = (digits[:, 0] * 10 + digits[:, 1]).astype(np.int8)
+    for i in np.flatnonzero(~ok):
+        hours[i] = parse_hour(timestamps[i])
+    return hours
+
+
+def feature_column(records, name, dtype=float):
+    if name == "hour":
+        return parse_hours([r.get("timestamp") for r in records]).astype(dtype)
+    default = "" if dtype is str else 0
+    return np.array([r.get(name) or default for r in records], dtype=dtype)
+
+
+def feature_matrix(records, names):
+    X = np.empty((len(records), len(names)), dtype=float)
+    for j, name in enumerate(names):
+        X[:, j] = feature_column(records, name)
+    return X
+
+
 # Event message generator
 def generate_message(device, sensor_val, action, timestamp, identity=None):
-    ts = pd.to_datetime(timestamp).strftime("%H:%M")
+    ts = parse_timestamp(timestamp).strftime("%H:%M")
     if device == "motor":
         return f"Water pump {'should be turned ON' if action == 1 else 'can remain OFF'}? Soil moisture {sensor_val}"
     elif device == "ac":
@@ -82,145 +475,538 @@ def generate_random_event():
 
 # Generate multiple events
 @app.post("/generate_data")
-def generate_data(count: int = 100):
-    batch = db.batch()
-    for _ in range(count):
-        ev = generate_random_event()
-        ref = db.collection("events").document(ev["id"])
-        batch.set(ref, ev)
-    batch.commit()
-    return {"status": "ok", "generated": count}
+def generate_data(count: int = 100, chunk_size: int = GENERATE_CHUNK_SIZE):
+    chunk_size = max(1, min(chunk_size, store.max_batch_size))
+    max_in_flight = GENERATE_WORKERS * 2
+    start = time.perf_counter()
+    generated = 0
+    chunks = 0
+
+    # Events are generated chunk by chunk and at most max_in_flight chunks are held in memory
+    with ThreadPoolExecutor(max_workers=GENERATE_WORKERS) as pool:
+        pending = set()
+        remaining = count
+        while remaining > 0:
+            size = min(chunk_size, remaining)
+            remaining -= size
+            pending.add(pool.submit(write_events, [generate_random_event() for _ in range(size)]))
+            chunks += 1
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                generated += sum(f.result() for f in done)
+        generated += sum(f.result() for f in pending)
+
+    elapsed = time.perf_counter() - start
+    return {
+        "status": "ok",
+        "generated": generated,
+        "chunks": chunks,
+        "elapsed_sec": round(elapsed, 3),
+        "events_per_sec": round(generated / elapsed, 1) if elapsed > 0 else None
+    }
 
 
-# Train predictive models
-@app.post("/train_models")
-def train_models():
-    docs = db.collection("events").stream()
-    rows = [d.to_dict() for d in docs]
-    if not rows:
+# Training data cache: events are converted chunk by chunk into typed
+# per-feature columns on disk, with the newest trained timestamp as watermark.
+TRAINING_COLUMNS = {
+    "hour": np.int8,
+    "temperature": np.float32,
+    "humidity": np.float32,
+    "soilMoisture": np.float32,
+    "relay1": np.int8,
+    "ac_on": np.int8,
+    "identity": str,
+}
+TRAINING_DATA_FORMAT = 2
+
+# name -> (model path, feature columns, label column, only rows with an identity)
+TRAINING_MODELS = {
+    "motor": (MODEL_MOTOR, MOTOR_FEATURES, "relay1", False),
+    "ac": (MODEL_AC, AC_FEATURES, "ac_on", False),
+    "face": (MODEL_FACE, FACE_FEATURES, "identity", True),
+}
+MIN_FACE_ROWS = 6
+
+
+def events_to_columns(events):
+    return {name: feature_column(events, name, dtype) for name, dtype in TRAINING_COLUMNS.items()}
+
+
+def training_arrays(columns, features, label, faces_only):
+    rows = columns["identity"] != "" if faces_only else slice(None)
+    X = np.column_stack([columns[name][rows] for name in features])
+    y = columns[label][rows]
+    return X, y if faces_only else y.astype(int)
+
+
+class TrainingDataCache:
+    # Each column is a raw typed file that new rows are appended to in place;
+    # state.json holds the committed row count, so bytes past it (an interrupted
+    # append) are never read and get overwritten. Identities are stored as int32
+    # codes into state["identities"], -1 meaning no identity.
+    def __init__(self, directory=TRAINING_DATA_DIR):
+        self.directory = directory
+        self.state_path = os.path.join(directory, "state.json")
+
+    def state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path) as f:
+            state = json.load(f)
+        # Caches in the older .npy layout are rebuilt from the event store
+        return state if state.get("format") == TRAINING_DATA_FORMAT else {}
+
+    def watermark(self):
+        return self.state().get("watermark")
+
+    def load(self, names=TRAINING_COLUMNS):
+        # Memory-mapped views of the cached rows; nothing is read until used
+        state = self.state()
+        rows = state.get("rows", 0)
+        if not rows:
+            return None
+        columns = {}
+        for name in names:
+            values = np.memmap(self._column_path(name), dtype=self._dtype(name), mode="r", shape=(rows,))
+            if name == "identity":
+                values = np.array(state["identities"] + [""])[values]
+            columns[name] = values
+        return columns
+
+    def append(self, columns, watermark):
+        os.makedirs(self.directory, exist_ok=True)
+        state = self.state()
+        rows = state.get("rows", 0)
+        codes = {name: i for i, name in enumerate(state.get("identities", []))}
+        for name, values in columns.items():
+            if name == "identity":
+                values = [codes.setdefault(v, len(codes)) if v else -1 for v in values]
+            values = np.ascontiguousarray(values, dtype=self._dtype(name))
+            with open(self._column_path(name), "ab") as f:
+                f.truncate(rows * values.itemsize)
+                f.write(values.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        state = {
+            "format": TRAINING_DATA_FORMAT,
+            "watermark": watermark,
+            "rows": rows + len(columns["hour"]),
+            "face_rows": state.get("face_rows", 0) + int((columns["identity"] != "").sum()),
+            "identities": list(codes),
+        }
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def reset(self):
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def _column_path(self, name):
+        return os.path.join(self.directory, f"{name}.bin")
+
+    def _dtype(self, name):
+        return np.int32 if name == "identity" else TRAINING_COLUMNS[name]
+
+
+training_data = TrainingDataCache()
+
+
+def fit_forest(model_path, new_X, new_y, load_all, has_history, incremental):
+    # Warm start adds trees fitted on the new rows only; it needs the same label
+    # set as the existing forest, otherwise fall back to a full refit. Only the
+    # full refit calls load_all, which materializes the whole history.
+    model, _ = models.get(model_path) if incremental else (None, None)
+    if model is not None and has_history and len(new_y) and set(np.unique(new_y)) == set(model.classes_):
+        model = copy.deepcopy(model)
+        model.set_params(warm_start=True, n_estimators=model.n_estimators + INCREMENTAL_TREES)
+        model.fit(new_X, new_y)
+        if len(model.estimators_) > MAX_TREES:
+            model.estimators_ = model.estimators_[-MAX_TREES:]
+            model.n_estimators = MAX_TREES
+        strategy = "warm_start"
+    else:
+        X, y = load_all()
+        model = RandomForestClassifier(n_estimators=100, random_state=42, n_jobs=TRAINING_N_JOBS)
+        model.fit(X, y)
+        strategy = "full"
+    return models.publish(model_path, model), strategy
+
+
+# Training jobs: /train_models runs in the background and is polled by job id.
+# One job runs at a time; within a job the models are fitted in parallel.
+training_jobs = OrderedDict()
+training_jobs_lock = threading.Lock()
+training_executor = ThreadPoolExecutor(max_workers=1)
+model_fit_executor = ThreadPoolExecutor(max_workers=3)
+
+
+def update_job(job, **fields):
+    with training_jobs_lock:
+        job.update(fields)
+
+
+def fit_job_model(job, name, new_columns, incremental, data_count):
+    model_path, features, label, faces_only = TRAINING_MODELS[name]
+    update_job(job["models"][name], status="running")
+    start = time.perf_counter()
+    new_X, new_y = training_arrays(new_columns, features, label, faces_only)
+
+    def load_all():
+        names = set(features) | {label, "identity"}
+        cached = training_data.load(names)
+        columns = new_columns if cached is None else {n: np.concatenate([cached[n], new_columns[n]]) for n in names}
+        return training_arrays(columns, features, label, faces_only)
+
+    has_history = data_count > len(new_y)
+    version, strategy = fit_forest(model_path, new_X, new_y, load_all, has_history, incremental)
+    update_job(job["models"][name], status="done", seconds=round(time.perf_counter() - start, 3),
+               version=version, strategy=strategy, data_count=data_count)
+
+
+def run_training(job):
+    update_job(job, status="running", started_at=datetime.utcnow().isoformat())
+    try:
+        result = train(job)
+        update_job(job, status="done", result=result)
+    except HTTPException as e:
+        update_job(job, status="failed", error=e.detail)
+    except Exception as e:
+        update_job(job, status="failed", error=str(e))
+    update_job(job, finished_at=datetime.utcnow().isoformat())
+
+
+def train(job):
+    incremental = job["incremental"]
+    if not incremental:
+        training_data.reset()
+
+    # Pull only events newer than the watermark, converting each chunk to typed arrays
+    chunks = []
+    watermark = training_data.watermark()
+    events = store.stream_events(since=watermark)
+    while True:
+        with timed("storage"):
+            chunk = list(islice(events, TRAINING_CHUNK_SIZE))
+        if not chunk:
+            break
+        watermark = max(filter(None, [watermark] + [ev.get("timestamp") for ev in chunk]), default=None)
+        chunks.append(events_to_columns(chunk))
+
+    new_rows = sum(len(c["hour"]) for c in chunks)
+    new_columns = {name: np.concatenate([c[name] for c in chunks]) for name in TRAINING_COLUMNS} if chunks else None
+
+    # Row counts come from the cache state; the cached columns themselves are
+    # only read by a model that falls back to a full refit.
+    state = training_data.state()
+    data_count = state.get("rows", 0) + new_rows
+    if data_count == 0:
         raise HTTPException(400, "No data available to train models.")
-
-    df = pd.DataFrame(rows)
-    df['hour'] = pd.to_datetime(df['timestamp']).dt.hour
-    df = df.fillna(0)
-
-    # Motor model
-    X_motor = df[['hour', 'temperature', 'humidity', 'soilMoisture']]
-    y_motor = df['relay1'].astype(int)
-    model_motor = RandomForestClassifier(n_estimators=100, random_state=42)
-    model_motor.fit(X_motor, y_motor)
-    joblib.dump(model_motor, MODEL_MOTOR)
-
-    # AC model
-    X_ac = df[['hour', 'temperature', 'humidity']]
-    y_ac = df['ac_on'].astype(int)
-    model_ac = RandomForestClassifier(n_estimators=100, random_state=42)
-    model_ac.fit(X_ac, y_ac)
-    joblib.dump(model_ac, MODEL_AC)
-
-    # Face recognition model
-    face_data = df[df['identity'].notnull()].copy()
-    if len(face_data) > 5:
-        face_data['identity'] = face_data['identity'].astype(str)
-        X_face = face_data[['hour']]
-        y_face = face_data['identity']
-        model_face = RandomForestClassifier(n_estimators=100, random_state=42)
-        model_face.fit(X_face, y_face)
-        joblib.dump(model_face, MODEL_FACE)
+    if incremental and new_rows == 0:
+        return {"status": "up_to_date", "new_data_count": 0, "watermark": watermark}
+    face_count = state.get("face_rows", 0) + int((new_columns["identity"] != "").sum())
+
+    counts = {"motor": data_count, "ac": data_count}
+    if face_count >= MIN_FACE_ROWS:
+        counts["face"] = face_count
+
+    update_job(job, models={name: {"status": "queued"} for name in counts})
+    futures = [
+        model_fit_executor.submit(fit_job_model, job, name, new_columns, incremental, count)
+        for name, count in counts.items()
+    ]
+    for future in futures:
+        future.result()
+
+    # New rows are appended only once every model is published, so a failed fit
+    # leaves the cache and watermark untouched and the next run retries them.
+    training_data.append(new_columns, watermark)
 
     return {
         "status": "trained",
-        "motor_data_count": len(X_motor),
-        "ac_data_count": len(X_ac),
-        "face_data_count": len(face_data)
+        "motor_data_count": data_count,
+        "ac_data_count": data_count,
+        "face_data_count": face_count,
+        "new_data_count": new_rows,
+        "watermark": watermark,
+        "model_versions": {name: m["version"] for name, m in job["models"].items()}
     }
 
 
-# Motor alert
-@app.post("/alert/motor")
-def motor_alert(payload: dict, confidence_threshold: float = 0.5):
-    if not os.path.exists(MODEL_MOTOR):
-        raise HTTPException(400, "Motor model not trained yet.")
+# Train predictive models (returns a job id immediately)
+@app.post("/train_models")
+def train_models(incremental: bool = False):
+    job_id = str(uuid.uuid4())
+    job = {
+        "job_id": job_id,
+        "status": "queued",
+        "incremental": incremental,
+        "created_at": datetime.utcnow().isoformat(),
+        "models": {},
+    }
+    with training_jobs_lock:
+        training_jobs[job_id] = job
+        while len(training_jobs) > MAX_TRAINING_JOBS:
+            training_jobs.popitem(last=False)
+    training_executor.submit(run_training, job)
+    return {"job_id": job_id, "status": "queued"}
+
+
+# Training job status
+@app.get("/train_models/{job_id}")
+def training_job_status(job_id: str):
+    with training_jobs_lock:
+        job = training_jobs.get(job_id)
+        if job is None:
+            raise HTTPException(404, f"Training job {job_id} not found.")
+        return copy.deepcopy(job)
+
+
+# Prediction helpers
+def predict_with_proba(model, X):
+    # One predict_proba pass; the predicted class is the argmax of the probabilities
+    with timed("predict_proba"):
+        proba = model.predict_proba(X)
+    best = proba.argmax(axis=1)
+    return model.classes_[best], proba[np.arange(len(best)), best]
+
+
+def score_rows(model_path, label, X):
+    model, model_version = models.get(model_path)
+    if model is None:
+        raise HTTPException(400, f"{label} model not trained yet.")
+    if len(X) == 0:
+        return [], [], model_version
+
+    preds, probs = predict_with_proba(model, X)
+    return preds, probs, model_version
+
+
+# Request coalescer: collects concurrent single-item calls for up to
+# COALESCE_WAIT_MS (or COALESCE_MAX_BATCH rows) and scores them as one matrix.
+class PredictionCoalescer:
+    def __init__(self, model_path, label, max_wait_ms=COALESCE_WAIT_MS, max_batch=COALESCE_MAX_BATCH):
+        self.model_path = model_path
+        self.label = label
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch = max_batch
+        self.batch_sizes = Counter()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def score(self, X):
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, daemon=True)
+                    self._worker.start()
+
+        future = Future()
+        self._queue.put((X, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            count = len(pending[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while count < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                pending.append(item)
+                count += len(item[0])
+            self._flush(pending)
+
+    def _flush(self, pending):
+        X = np.vstack([item_X for item_X, _ in pending])
+        self.batch_sizes[len(X)] += 1
+        try:
+            preds, probs, model_version = score_rows(self.model_path, self.label, X)
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+
+        offset = 0
+        for item_X, future in pending:
+            end = offset + len(item_X)
+            future.set_result((preds[offset:end], probs[offset:end], model_version))
+            offset = end
+
+    def stats(self):
+        sizes = dict(sorted(self.batch_sizes.items()))
+        return {
+            "batches": sum(sizes.values()),
+            "items": sum(size * n for size, n in sizes.items()),
+            "batch_sizes": sizes,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "max_batch": self.max_batch,
+        }
+
+
+coalescers = {
+    MODEL_MOTOR: PredictionCoalescer(MODEL_MOTOR, "Motor"),
+    MODEL_AC: PredictionCoalescer(MODEL_AC, "AC"),
+}
+
+
+def run_predictions(model_path, label, payloads, feature_names, build_response, confidence_threshold, coalesce=False):
+    with timed("feature_build"):
+        features = feature_matrix(payloads, feature_names)
+    if coalesce and COALESCE_ALERTS and model_path in coalescers:
+        preds, probs, model_version = coalescers[model_path].score(features)
+    else:
+        preds, probs, model_version = score_rows(model_path, label, features)
+
+    results = []
+    for payload, row, pred, prob in zip(payloads, features, preds, probs):
+        result = build_response(payload, row, pred, float(prob), confidence_threshold)
+        result["model_version"] = model_version
+        results.append(result)
+    return results
+
+
+def motor_response(payload, row, pred, prob, confidence_threshold):
+    motor_pred = int(pred)
+    action_msg = "TURN ON" if motor_pred == 1 else "STAY OFF"
+    if prob < confidence_threshold:
+        action_msg += " (low confidence)"
+
+    msg = f"Soil moisture {payload.get('soilMoisture', 0)}, motor suggested action: {action_msg}"
+    return {"motor_action": motor_pred, "probability": prob, "message": msg}
+
+
+def ac_response(payload, row, pred, prob, confidence_threshold):
+    ac_pred = int(pred)
+    action_msg = "TURN ON" if ac_pred == 1 else "STAY OFF"
+    if prob < confidence_threshold:
+        action_msg += " (low confidence)"
 
-    ts = payload.get("timestamp") or datetime.utcnow().isoformat()
-    hour = pd.to_datetime(ts).hour
-    soil = payload.get("soilMoisture", 0)
     temp = payload.get("temperature", 0)
     hum = payload.get("humidity", 0)
+    msg = f"Room temp {temp}°C, humidity {hum}%. AC suggested action: {action_msg}"
+    return {"ac_action": ac_pred, "probability": prob, "message": msg}
 
-    model_motor = joblib.load(MODEL_MOTOR)
-    X_motor = np.array([[hour, temp, hum, soil]])
-    motor_pred = int(model_motor.predict(X_motor)[0])
-    motor_prob = float(max(model_motor.predict_proba(X_motor)[0]))
 
-    action_msg = "TURN ON" if motor_pred == 1 else "STAY OFF"
-    if motor_prob < confidence_threshold:
-        action_msg += " (low confidence)"
+def face_response(payload, row, pred, prob, confidence_threshold):
+    identity_pred = str(pred)
+    msg = f"Likely person around {int(row[0])}:00 is {identity_pred} (confidence: {prob:.2f})"
+    if prob < confidence_threshold:
+        msg += " (low confidence)"
 
-    msg = f"Soil moisture {soil}, motor suggested action: {action_msg}"
-    return {"motor_action": motor_pred, "probability": motor_prob, "message": msg}
+    return {"likely_person": identity_pred, "confidence": prob, "message": msg}
+
+
+# Motor alert
+@app.post("/alert/motor")
+def motor_alert(payload: dict, confidence_threshold: float = 0.5):
+    return run_predictions(MODEL_MOTOR, "Motor", [payload], MOTOR_FEATURES, motor_response, confidence_threshold, coalesce=True)[0]
+
+
+@app.post("/alert/motor/batch")
+def motor_alert_batch(payloads: List[dict], confidence_threshold: float = 0.5):
+    results = run_predictions(MODEL_MOTOR, "Motor", payloads, MOTOR_FEATURES, motor_response, confidence_threshold)
+    return {"results": results, "count": len(results)}
 
 
 # AC alert
 @app.post("/alert/ac")
 def ac_alert(payload: dict, confidence_threshold: float = 0.5):
-    if not os.path.exists(MODEL_AC):
-        raise HTTPException(400, "AC model not trained yet.")
+    return run_predictions(MODEL_AC, "AC", [payload], AC_FEATURES, ac_response, confidence_threshold, coalesce=True)[0]
 
-    ts = payload.get("timestamp") or datetime.utcnow().isoformat()
-    hour = pd.to_datetime(ts).hour
-    temp = payload.get("temperature", 0)
-    hum = payload.get("humidity", 0)
 
-    model_ac = joblib.load(MODEL_AC)
-    X_ac = np.array([[hour, temp, hum]])
-    ac_pred = int(model_ac.predict(X_ac)[0])
-    ac_prob = float(max(model_ac.predict_proba(X_ac)[0]))
-
-    action_msg = "TURN ON" if ac_pred == 1 else "STAY OFF"
-    if ac_prob < confidence_threshold:
-        action_msg += " (low confidence)"
-
-    msg = f"Room temp {temp}°C, humidity {hum}%. AC suggested action: {action_msg}"
-    return {"ac_action": ac_pred, "probability": ac_prob, "message": msg}
+@app.post("/alert/ac/batch")
+def ac_alert_batch(payloads: List[dict], confidence_threshold: float = 0.5):
+    results = run_predictions(MODEL_AC, "AC", payloads, AC_FEATURES, ac_response, confidence_threshold)
+    return {"results": results, "count": len(results)}
 
 
 # Face hourly prediction
 @app.post("/predict/face_hourly")
 def face_hourly_predict(payload: dict, confidence_threshold: float = 0.5):
-    if not os.path.exists(MODEL_FACE):
-        raise HTTPException(400, "Face model not trained yet.")
+    return run_predictions(MODEL_FACE, "Face", [payload], FACE_FEATURES, face_response, confidence_threshold)[0]
 
-    ts = payload.get("timestamp") or datetime.utcnow().isoformat()
-    hour = pd.to_datetime(ts).hour
 
-    model_face = joblib.load(MODEL_FACE)
-    X_face = np.array([[hour]])
-    identity_pred = model_face.predict(X_face)[0]
-    confidence = float(max(model_face.predict_proba(X_face)[0]))
+@app.post("/predict/face_hourly/batch")
+def face_hourly_predict_batch(payloads: List[dict], confidence_threshold: float = 0.5):
+    results = run_predictions(MODEL_FACE, "Face", payloads, FACE_FEATURES, face_response, confidence_threshold)
+    return {"results": results, "count": len(results)}
 
-    msg = f"Likely person around {hour}:00 is {identity_pred} (confidence: {confidence:.2f})"
-    if confidence < confidence_threshold:
-        msg += " (low confidence)"
 
-    return {"likely_person": identity_pred, "confidence": confidence, "message": msg}
+# Coalescer batch-size counters
+@app.get("/alert/coalescer/stats")
+def coalescer_stats():
+    return {
+        "enabled": COALESCE_ALERTS,
+        "motor": coalescers[MODEL_MOTOR].stats(),
+        "ac": coalescers[MODEL_AC].stats(),
+    }
+
+
+# Loaded model versions
+@app.get("/models")
+def model_versions():
+    return {"versions": models.versions()}
+
+
+# Prometheus metrics
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    lines = ["# HELP http_requests_total HTTP requests by route and status.", "# TYPE http_requests_total counter"]
+    with request_counts_lock:
+        counts = sorted(request_counts.items())
+    for (method, route, status), count in counts:
+        lines.append(f'http_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+
+    lines += request_latency.render()
+    lines += stage_latency.render()
+
+    lines += ["# HELP model_version Loaded model version (file mtime in ns).", "# TYPE model_version gauge"]
+    names = {MODEL_MOTOR: "motor", MODEL_AC: "ac", MODEL_FACE: "face"}
+    for path, version in sorted(models.loaded_versions().items()):
+        lines.append(f'model_version{{model="{names.get(path, path)}"}} {version}')
+    return "\n".join(lines) + "\n"
 
 
 # Feedback saving
 @app.post("/feedback")
 def save_feedback(f: Feedback):
-    db.collection("events").document(f.prediction_id).update({
-        "feedback": 1 if f.accepted else 0
-    })
+    try:
+        with timed("storage"):
+            store.update_event(f.prediction_id, {"feedback": 1 if f.accepted else 0})
+    except KeyError:
+        raise HTTPException(404, f"Event {f.prediction_id} not found.")
+    history_cache.invalidate()
     return {"status": "feedback_saved"}
 
 
 # Event history retrieval
 @app.get("/events/history")
-def get_event_history(device_id: Optional[str] = None, limit: int = 50):
-    query = db.collection("events").order_by("timestamp", direction=firestore.Query.DESCENDING).limit(limit)
-    if device_id:
-        query = query.where("device_id", "==", device_id)
-    docs = query.stream()
-    events = [doc.to_dict() for doc in docs]
-    return {"events": events, "count": len(events)}
+def get_event_history(
+    device_id: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=MAX_HISTORY_LIMIT),
+    start_after: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None
+):
+    key = (device_id, limit, start_after, since, until)
+    result = history_cache.get(key)
+    if result is not None:
+        return {**result, "cached": True}
+
+    try:
+        with timed("storage"):
+            events = store.history(device_id, limit, start_after=start_after, since=since, until=until)
+    except KeyError:
+        raise HTTPException(400, f"Unknown cursor: {start_after}")
+
+    next_cursor = events[-1].get("id") if len(events) == limit else None
+    result = {"events": events, "count": len(events), "next_cursor": next_cursor}
+    history_cache.put(key, result)
+    return {**result, "cached": False}